@@ -17,11 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 from bson.code import Code
+from bson.son import SON
 from tornado import gen
 from mongotor.node import ReadPreference
-from mongotor.cursor import Cursor
+from mongotor.cursor import Cursor, _MergedCursors, ASCENDING, DESCENDING
 from mongotor import message
 from mongotor import helpers
+from mongotor import monitoring
+from mongotor.errors import Error
 
 log = logging.getLogger(__name__)
 
@@ -34,7 +37,8 @@ class Client(object):
         self._collection_name = database.get_collection_name(collection)
 
     @gen.engine
-    def insert(self, doc_or_docs, safe=True, check_keys=True, callback=None):
+    def insert(self, doc_or_docs, safe=True, check_keys=True,
+               network_timeout=None, callback=None):
         """Insert a document
 
         :Parameters:
@@ -44,6 +48,8 @@ class Client(object):
           - `check_keys` (optional): check if keys start with '$' or
             contain '.', raising :class:`~pymongo.errors.InvalidName`
             in either case
+          - `network_timeout` (optional): seconds to wait for the
+            response of a safe insert
           - `callback` : method which will be called when save is finished
         """
         if isinstance(doc_or_docs, dict):
@@ -54,24 +60,23 @@ class Client(object):
         message_insert = message.insert(self._collection_name, doc_or_docs,
                                         check_keys, safe, {})
 
-        log.debug("mongo: db.{0}.insert({1})".format(self._collection_name, doc_or_docs))
-
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
-
-        response, error = yield gen.Task(connection.send_message,
-                                         message_insert, safe)
+        response, error = yield gen.Task(self._send_write, message_insert,
+            safe, network_timeout, monitoring._command_event('insert',
+                self._collection_name, batch_size=len(doc_or_docs)))
 
         if callback:
             callback((response, error))
 
     @gen.engine
-    def remove(self, spec_or_id={}, safe=True, callback=None):
+    def remove(self, spec_or_id={}, safe=True, network_timeout=None,
+               callback=None):
         """remove a document
 
         :Parameters:
         - `spec_or_id`: a query or a document id
         - `safe` (optional): safe insert operation
+        - `network_timeout` (optional): seconds to wait for the response
+          of a safe remove
         - `callback` : method which will be called when save is finished
         """
         if not isinstance(spec_or_id, dict):
@@ -82,19 +87,16 @@ class Client(object):
         message_delete = message.delete(self._collection_name, spec_or_id,
                                         safe, {})
 
-        log.debug("mongo: db.{0}.remove({1})".format(self._collection_name, spec_or_id))
-        node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
-        connection = yield gen.Task(node.connection)
-
-        response, error = yield gen.Task(connection.send_message,
-                                         message_delete, safe)
+        response, error = yield gen.Task(self._send_write, message_delete,
+            safe, network_timeout, monitoring._command_event('delete',
+                self._collection_name, spec=spec_or_id))
 
         if callback:
             callback((response, error))
 
     @gen.engine
     def update(self, spec, document, upsert=False, safe=True,
-               multi=False, callback=None):
+               multi=False, network_timeout=None, callback=None):
         """Update a document(s) in this collection.
 
         :Parameters:
@@ -113,6 +115,8 @@ class Client(object):
             might eventually change to ``True``. It is recommended
             that you specify this argument explicitly for all update
             operations in order to prepare your code for that change.
+          - `network_timeout` (optional): seconds to wait for the
+            response of a safe update
         """
         assert isinstance(spec, dict), "spec must be an instance of dict"
         assert isinstance(document, dict), "document must be an instance of dict"
@@ -122,14 +126,26 @@ class Client(object):
         message_update = message.update(self._collection_name, upsert,
                                         multi, spec, document, safe, {})
 
-        log.debug("mongo: db.{0}.update({1}, {2}, {3}, {4})".format(
-            self._collection_name, spec, document, upsert, multi))
+        response, error = yield gen.Task(self._send_write, message_update,
+            safe, network_timeout, monitoring._command_event('update',
+                self._collection_name, spec=spec))
+
+        callback((response, error))
 
+    @gen.engine
+    def _send_write(self, message, safe, network_timeout, event, callback):
         node = yield gen.Task(self._database.get_node, ReadPreference.PRIMARY)
         connection = yield gen.Task(node.connection)
 
-        response, error = yield gen.Task(connection.send_message,
-                                         message_update, safe)
+        try:
+            response, error = yield gen.Task(connection.send_message,
+                message, safe, network_timeout=network_timeout, event=event)
+        except Error, e:
+            node.check_error(e)
+            raise
+
+        if error:
+            node.check_error(error)
 
         callback((response, error))
 
@@ -199,14 +215,37 @@ class Client(object):
             examined when performing the query
           - `read_preferences` (optional): The read preference for
             this query.
+          - `network_timeout` (optional): seconds to wait for the
+            response before failing with
+            :class:`~mongotor.errors.TimeoutError`
+          - `as_class` (optional): class to use for the returned documents
+          - `tz_aware` (optional): return timezone aware datetimes
+          - `batch_size` (optional): the number of documents returned by
+            each round trip to the server, 0 lets the server decide
+          - `prefetch` (optional): number of batches fetched ahead while
+            the application handles the current one. They are fetched
+            one after the other unless the connection is pipelined
+          - `prefetch_max_bytes` (optional): stop fetching ahead while
+            the fetched batches hold this many bytes, 0 for unlimited
+          - `raw` (optional): return
+            :class:`~mongotor.raw_bson.RawBSONDocument` instances, which
+            keep the BSON bytes and are only decoded when a field is read
+          - `await_data` (optional): a tailable cursor waits at the
+            server for new documents instead of returning empty batches
+          - `oplog_replay` (optional): the query is on the oplog and
+            filters on ``ts``, letting the server skip to the first
+            matching entry
+          - `exhaust` (optional): the server sends every batch as soon
+            as the previous one was sent, without waiting for a getMore.
+            The connection is kept busy until all documents were read,
+            can't be used with `limit` nor with a pipelined pool
+          - `balancing` (optional): a :class:`~mongotor.node.Balancing`
+            overriding the one of the database
+          - `tag_sets` (optional): tag sets of the nodes the query may be
+            sent to, overriding the ones of the database, see
+            :class:`~mongotor.node.ReadPreference`
         """
 
-        log.debug("mongo: db.{0}.find({spec}).limit({limit}).sort({sort})".format(
-            self._collection_name,
-            spec=args[0] if args else {},
-            sort=kwargs.get('sort', {}),
-            limit=kwargs.get('limit', '')
-        ))
         cursor = Cursor(self._database, self._collection, *args, **kwargs)
 
         if 'callback' in kwargs:
@@ -214,6 +253,149 @@ class Client(object):
         else:
             return cursor
 
+    def stream(self, spec=None, document_callback=None, callback=None, **kwargs):
+        """Query the database, handing each document to `document_callback`
+        as soon as it is read from the socket.
+
+        All arguments to :meth:`find` are also valid arguments for
+        :meth:`stream`. `callback` is called with the number of documents
+        found when the reply is over.
+        """
+        assert document_callback
+
+        cursor = Cursor(self._database, self._collection, spec, **kwargs)
+        cursor.stream(document_callback, callback=callback)
+
+    def tail(self, spec=None, callback=None, resume_delay=1, **kwargs):
+        """Follow a capped collection, or the oplog, handing each new
+        document to `callback` as it is inserted.
+
+        All arguments to :meth:`find` are also valid arguments for
+        :meth:`tail`, the cursor is tailable and awaits data unless told
+        otherwise. See :meth:`~mongotor.cursor.Cursor.tail` for how the
+        query is resumed after the server cursor dies.
+
+        Returns the cursor, call its :meth:`~mongotor.cursor.Cursor.close`
+        method to stop tailing.
+        """
+        assert callback
+
+        kwargs.setdefault('await_data', True)
+        cursor = Cursor(self._database, self._collection, spec,
+                        tailable=True, **kwargs)
+        cursor.tail(callback, resume_delay=resume_delay)
+
+        return cursor
+
+    @gen.engine
+    def parallel_scan(self, num_cursors, callback, read_preference=None,
+                      **kwargs):
+        """Scan the whole collection with up to `num_cursors` cursors read
+        at the same time, each one on its own connection while it gets
+        more documents, handing their documents to `callback` as they
+        arrive.
+
+        The collection is split by the parallelCollectionScan command.
+        On servers without it the collection is split in ranges of
+        ``_id``, bounded by the keys of the splitVector command or, when
+        that isn't allowed, guessed from the lowest and highest ``_id``.
+
+        :Parameters:
+          - `num_cursors`: the maximum number of cursors
+          - `callback`: called with a ``(document, error)`` tuple for each
+            document and with ``(None, None)`` when all cursors are
+            exhausted
+          - `read_preference` (optional): the read preference of the scan
+
+        Other arguments to :meth:`find`, e.g. `batch_size` or `prefetch`,
+        are given to each cursor.
+        """
+        assert num_cursors > 0
+
+        cursors = yield gen.Task(self._parallel_cursors, num_cursors,
+                                 read_preference, **kwargs)
+
+        _MergedCursors(cursors, callback).each()
+
+    @gen.engine
+    def _parallel_cursors(self, num_cursors, read_preference, callback,
+                          **kwargs):
+        node = yield gen.Task(self._database.get_node, read_preference)
+        connection = yield gen.Task(node.connection)
+
+        command = SON([('parallelCollectionScan', self._collection),
+                       ('numCursors', num_cursors)])
+        response, error = yield gen.Task(self._database._command, command,
+                                         connection=connection)
+
+        cursors = []
+        if not error and response and response.get('ok'):
+            # the server cursors live in the node which opened them
+            for result in response['cursors']:
+                cursor = Cursor(self._database, self._collection,
+                                read_preference=read_preference, **kwargs)
+                cursor._attach(node, result['cursor']['id'],
+                               result['cursor']['firstBatch'])
+                cursors.append(cursor)
+
+            callback(cursors)
+            return
+
+        bounds = yield gen.Task(self._split_bounds, num_cursors,
+                                read_preference)
+        for lower, upper in zip([None] + bounds, bounds + [None]):
+            spec = {}
+            if lower is not None:
+                spec['$gte'] = lower
+            if upper is not None:
+                spec['$lt'] = upper
+
+            cursors.append(Cursor(self._database, self._collection,
+                                  spec and {'_id': spec} or {},
+                                  read_preference=read_preference, **kwargs))
+
+        callback(cursors)
+
+    @gen.engine
+    def _split_bounds(self, parts, read_preference, callback):
+        """Get the ``_id`` values which split this collection in about
+        `parts` ranges of the same size.
+        """
+        # the chunks are sized from the stats of the member which splits
+        stats, error = yield gen.Task(self._database.command, 'collStats',
+                                      self._collection,
+                                      read_preference=read_preference)
+
+        response = None
+        if not error and stats and stats.get('ok'):
+            command = SON([('splitVector', self._collection_name),
+                           ('keyPattern', {'_id': 1}),
+                           ('maxChunkSizeBytes',
+                            max(1, int(stats['size']) // parts)),
+                           ('maxChunkObjects',
+                            max(1, int(stats['count']) // parts))])
+            response, error = yield gen.Task(self._database.command, command,
+                                             read_preference=read_preference)
+
+        if not error and response and response.get('ok'):
+            keys = [key['_id'] for key in response['splitKeys']]
+            if len(keys) >= parts:
+                keys = [keys[len(keys) * part // parts]
+                        for part in range(1, parts)]
+            callback(keys)
+            return
+
+        lowest, error = yield gen.Task(self.find_one, fields=['_id'],
+            sort={'_id': ASCENDING}, read_preference=read_preference)
+        highest, error = yield gen.Task(self.find_one, fields=['_id'],
+            sort={'_id': DESCENDING}, read_preference=read_preference)
+
+        if not lowest or not highest:
+            callback([])
+            return
+
+        callback(helpers._split_range(lowest['_id'], highest['_id'], parts))
+
     def distinct(self, key, callback):
         """Get a list of distinct values for `key` among all documents
         in this collection.
@@ -238,13 +420,16 @@ class Client(object):
         self.find().count(callback=callback)
 
     @gen.engine
-    def aggregate(self, pipeline, read_preference=None, callback=None):
+    def aggregate(self, pipeline, read_preference=None, tag_sets=None,
+                  callback=None):
         """Perform an aggregation using the aggregation framework on this
         collection.
 
         :Parameters:
           - `pipeline`: a single command or list of aggregation commands
           - `read_preference`
+          - `tag_sets` (optional): tag sets of the nodes the aggregation
+            may be sent to
 
         .. note:: Requires server version **>= 2.1.0**
 
@@ -259,13 +444,14 @@ class Client(object):
 
         response, error = yield gen.Task(self._database.command, "aggregate",
                                          self._collection, pipeline=pipeline,
-                                         read_preference=read_preference)
+                                         read_preference=read_preference,
+                                         tag_sets=tag_sets)
 
         callback(response)
 
     @gen.engine
     def group(self, key, condition, initial, reduce, finalize=None,
-              read_preference=None, callback=None):
+              read_preference=None, tag_sets=None, callback=None):
         """Perform a query similar to an SQL *group by* operation.
 
         Returns an array of grouped items.
@@ -287,6 +473,8 @@ class Client(object):
           - `initial`: initial value of the aggregation counter object
           - `reduce`: aggregation function as a JavaScript string
           - `finalize`: function to be called on each object in output list.
+          - `tag_sets` (optional): tag sets of the nodes the group may be
+            sent to
 
         """
 
@@ -305,6 +493,7 @@ class Client(object):
 
         response, error = yield gen.Task(self._database.command, "group",
                                          group,
-                                         read_preference=read_preference)
+                                         read_preference=read_preference,
+                                         tag_sets=tag_sets)
 
         callback(response)
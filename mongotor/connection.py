@@ -15,77 +15,313 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import with_statement
+from functools import partial
+from datetime import timedelta
 from tornado import iostream
 from tornado import stack_context
+from tornado.ioloop import IOLoop
 from mongotor.errors import InterfaceError, IntegrityError, \
-    ProgrammingError, DatabaseError
+    ProgrammingError, DatabaseError, TimeoutError, NotMasterError
 from mongotor import helpers
+from mongotor import monitoring
 import socket
 import logging
 import struct
 import contextlib
+import time
 
 logger = logging.getLogger(__name__)
 
 
 class Connection(object):
-
-    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5):
+    """Connection to a mongo node
+
+    :Parameters:
+      - `host`: mongo host
+      - `port`: mongo port
+      - `pool` (optional): pool which owns this connection
+      - `autoreconnect` (optional): reconnect when the connection was lost
+      - `timeout` (optional): seconds to wait for the connection to be
+        stabilished
+      - `pipelined` (optional): allow many requests to be in flight on this
+        connection at the same time, each reply is dispatched to its request
+        by the `responseTo` field of the reply header
+      - `coalesce_writes` (optional): buffer the messages sent during an
+        ioloop iteration and write them to the socket at once. `flushes`
+        counts those writes and `coalesced` the messages written by them
+
+    `latency` is a moving average of the seconds between sending a request
+    and reading its reply, None until a reply was read. `bytes_sent` and
+    `bytes_received` count the bytes of the messages written and read.
+
+    Queries with the exhaust flag get all their replies without a getMore,
+    the server sends each reply as an answer to the previous one until the
+    cursor id is 0.
+
+    Messages sent along with a :class:`~mongotor.monitoring.CommandEvent`
+    are reported to the command listeners of :mod:`mongotor.monitoring`.
+
+    """
+
+    def __init__(self, host, port, pool=None, autoreconnect=True, timeout=5,
+                 pipelined=False, coalesce_writes=False):
         self._host = host
         self._port = port
         self._pool = pool
         self._autoreconnect = autoreconnect
         self._timeout = timeout
+        self._pipelined = pipelined
+        self._coalesce_writes = coalesce_writes
+        self._write_buffer = []
+        self.flushes = 0
+        self.coalesced = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._reply_size = 0
+        self._checkout_wait = 0
+        self._write_events = []
         self._connected = False
-        self._callback = None
+        self._connecting = False
+        self._pinned = 0
+        self._checked_out = False
+        self._connect_timeout = None
+        self._requests = {}
+        self._request_timeouts = {}
+        self._streaming_callbacks = {}
+        self._exhaust = {}
+        self._sent_at = {}
+        self._reading = False
+        self.latency = None
 
         self._connect()
 
         logger.debug('{0} created'.format(self))
 
     def _connect(self):
+        """Connect without blocking the ioloop, messages sent while the
+        connection is in progress are buffered by the stream. Connection
+        errors are reported to the pending requests' callbacks
+        """
         self.usage = 0
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        stream = iostream.IOStream(s)
+        stream.set_close_callback(partial(self._socket_close, stream))
+
+        self._stream = stream
+        self._connected = True
+        self._connecting = True
+
+        if self._timeout:
+            self._connect_timeout = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._timeout),
+                partial(self._on_connect_timeout, stream))
+
+        stream.connect((self._host, self._port),
+                       partial(self._on_connect, stream))
+
+    def _on_connect(self, stream):
+        if stream is not self._stream:
+            return
+
+        self._remove_connect_timeout()
+        self._connecting = False
+        logger.debug('{0} connected to {1}:{2}'.format(self, self._host, self._port))
+
+        if self._requests:
+            self._read_reply()
+
+    def _on_connect_timeout(self, stream):
+        self._connect_timeout = None
+        if stream is not self._stream or self.closed():
+            return
+
+        logger.error('{0} timed out connecting to {1}:{2}'.format(self,
+                     self._host, self._port))
+        self._close(InterfaceError('connection timed out'))
+
+    def _write(self, message, event=None):
+        self.bytes_sent += len(message)
+        if not self._coalesce_writes:
+            self._stream.write(message)
+            if event:
+                monitoring._command_written(event)
+            return
+
+        self._write_buffer.append(message)
+        if event:
+            self._write_events.append(event)
+        if len(self._write_buffer) == 1:
+            with stack_context.NullContext():
+                IOLoop.instance().add_callback(self._flush)
+
+    def _flush(self):
+        messages, self._write_buffer = self._write_buffer, []
+        events, self._write_events = self._write_events, []
+        if not messages or self.closed():
+            return
+
+        self.flushes += 1
+        self.coalesced += len(messages)
+
         try:
-            socket.timeout(self._timeout)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.connect((self._host, self._port))
+            self._stream.write("".join(messages))
+        except Exception, e:
+            logger.error('{0} error writing {1} messages: {2}'.format(self,
+                         len(messages), e))
+            self._close(InterfaceError(e))
+            return
 
-            self._stream = iostream.IOStream(s)
-            self._stream.set_close_callback(self._socket_close)
+        for event in events:
+            monitoring._command_written(event)
 
-            self._connected = True
-        except socket.error, error:
-            raise InterfaceError(error)
+    def _remove_connect_timeout(self):
+        if self._connect_timeout:
+            IOLoop.instance().remove_timeout(self._connect_timeout)
+            self._connect_timeout = None
 
     def __repr__(self):
         return "Connection {0} ::: ".format(id(self))
 
-    def _parse_header(self, header):
+    @property
+    def in_flight(self):
+        """Number of requests waiting for a reply on this connection"""
+        return len(self._requests)
+
+    def _read_reply(self):
+        if self._reading or self._connecting:
+            return  # replies are read as soon as the connection is made
+
+        self._reading = True
+        # the replies are not read in the context of the request which
+        # started reading, the handler of each one has its own
+        with stack_context.NullContext():
+            self._stream.read_bytes(16,
+                callback=partial(self._parse_header, self._stream))
+
+    def _parse_header(self, stream, header):
+        if stream is not self._stream or stream.closed():
+            return  # read by a stream closed meanwhile
+
         #logger.debug('got data %r' % header)
-        length = int(struct.unpack("<i", header[:4])[0])
-        _request_id = struct.unpack("<i", header[8:12])[0]
+        with self.close_on_error():
+            length, reply_id, response_to, op_code = \
+                struct.unpack_from("<iiii", header)
 
-        assert _request_id == self._request_id, \
-            "ids don't match %r %r" % (self._request_id, _request_id)
+            operation = 1  # who knows why
+            assert operation == op_code
 
-        operation = 1  # who knows why
-        assert operation == struct.unpack("<i", header[12:])[0]
+        self.bytes_received += length
+        self._reply_size = length
         #logger.debug('%s' % length)
         #logger.debug('waiting for another %d bytes' % (length - 16))
 
-        self._stream.read_bytes(length - 16, callback=self._parse_response)
+        stream.read_bytes(length - 16,
+            callback=partial(self._parse_response, stream, response_to,
+                             reply_id),
+            streaming_callback=self._streaming_callbacks.pop(response_to, None))
+
+    def _parse_response(self, stream, response_to, reply_id, response):
+        if stream is not self._stream or stream.closed():
+            return  # its requests were failed when the stream was closed
+
+        self._reading = False
+
+        handler = self._requests.pop(response_to, None)
+        self._remove_request_timeout(response_to)
+        if handler is None:
+            logger.warn('{0} discarding reply to unknown request {1}'
+                        .format(self, response_to))
+
+        now = time.time()
+        sent_at = self._sent_at.pop(response_to, None)
+        if sent_at is not None:
+            self._update_latency(now - sent_at)
+
+        if response_to in self._exhaust:
+            network_timeout = self._exhaust.pop(response_to)
+            if handler and helpers._reply_cursor_id(response):
+                # the next batch comes as the reply to this one
+                self._requests[reply_id] = handler
+                self._exhaust[reply_id] = network_timeout
+                self._sent_at[reply_id] = now
+                self._add_request_timeout(reply_id, network_timeout)
+
+        if self._requests:
+            self._read_reply()
+        else:
+            self.release()
 
-    def _parse_response(self, response):
-        callback = self._callback
-        check_response = self._check_response
-        self.reset()
-        self.release()
+        #logger.debug('response: %s' % response)
+        if handler:
+            self._run_callback(handler, response)
 
-        if check_response:
-            response = self.__check_response_to_last_error(response)
+    def _run_callback(self, callback, *args, **kwargs):
+        # neither the stream nor the other requests of the connection are
+        # hurt by a raising callback, the exceptions its own stack context
+        # doesn't handle are logged
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            IOLoop.instance().handle_callback_exception(callback)
 
-        #logger.debug('response: %s' % response)
-        callback((response, None))
+    def _update_latency(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += (elapsed - self.latency) * 0.2
+
+    def _on_stream(self, request_id, streaming_callback, chunk):
+        if request_id in self._requests:  # request may have timed out
+            streaming_callback(chunk)
+
+    def _on_request_timeout(self, request_id):
+        self._request_timeouts.pop(request_id, None)
+        self._streaming_callbacks.pop(request_id, None)
+        self._exhaust.pop(request_id, None)
+        self._sent_at.pop(request_id, None)
+        handler = self._requests.pop(request_id, None)
+        if handler is None:
+            return
+
+        logger.error('{0} request {1} timed out'.format(self, request_id))
+
+        if not self._pipelined:
+            # the late reply would be read by the next request, so the
+            # socket is dropped and the connection given back
+            self._close(InterfaceError('connection closed'))
+
+        self._run_callback(handler, error=TimeoutError('operation timed out'))
+
+    def _remove_request_timeout(self, request_id):
+        timeout = self._request_timeouts.pop(request_id, None)
+        if timeout:
+            IOLoop.instance().remove_timeout(timeout)
+
+    def _on_response(self, callback, check_response, event, response=None,
+                     error=None):
+        if error is not None:
+            monitoring._command_failed(event, error)
+        elif event:
+            monitoring._command_replied(event, self._reply_size)
+
+        if error is None and check_response:
+            started = time.time()
+            try:
+                response = self.__check_response_to_last_error(response)
+            except Exception, e:
+                monitoring._command_failed(event, e)
+                raise
+
+            if event:
+                monitoring._command_decoded(event, time.time() - started)
+                monitoring._command_succeeded(event)
+
+        if callback:
+            callback((response, error))
 
     def __check_response_to_last_error(self, response):
         """Check a response to a lastError message for errors.
@@ -114,6 +350,9 @@ class Connection(object):
                     details = errobj
                     break
 
+        if error_msg.startswith("not master"):
+            raise NotMasterError(details["err"], details.get("code"))
+
         if "code" in details:
             if details["code"] in [11000, 11001, 12582]:
                 raise IntegrityError(details["err"])
@@ -122,35 +361,75 @@ class Connection(object):
         else:
             raise DatabaseError(details["err"])
 
-    def _socket_close(self):
+    def _socket_close(self, stream):
+        if stream is not self._stream:
+            return  # a stream replaced by reconnection
+
         logger.debug('{0} connection stream closed'.format(self))
-        if self._callback:
-            self._callback((None, InterfaceError('connection closed')))
+        self._remove_connect_timeout()
+        self._fail_requests(InterfaceError(getattr(stream, 'error', None) or
+                                           'connection closed'))
 
-        self.reset()
         self._connected = False
+        self._connecting = False
         self.release()
 
+    def _fail_requests(self, error):
+        requests = self._requests
+        self.reset()
+
+        for handler in requests.itervalues():
+            self._run_callback(handler, error=error)
+
     def close(self):
         logger.debug('{0} connection close'.format(self))
-        if self._callback:
-            self._callback((None, InterfaceError('connection closed')))
+        self._flush()
+        self._close(InterfaceError('connection closed'))
+
+    def _close(self, error):
+        self._remove_connect_timeout()
+        self._write_buffer = []
+        self._write_events = []
 
-        self.reset()
         self._connected = False
+        self._connecting = False
+        # the close callback would fail the requests and release the
+        # connection once more, after the handlers may have released it
+        self._stream.set_close_callback(None)
         self._stream.close()
 
+        self._fail_requests(error)
+        if not self._requests:
+            self.release()
+
     def closed(self):
         return not self._connected
 
     def release(self):
-        if self._pool:
+        if self._pool and not self._pinned:
             self._pool.release(self)
 
+    def pin(self):
+        """Keep this connection out of its pool until :meth:`unpin` is
+        called, e.g. while a cursor is open on it.
+        """
+        self._pinned += 1
+
+    def unpin(self):
+        self._pinned -= 1
+        if not self._pinned and not self._requests:
+            self.release()
+
     def reset(self):
-        self._callback = None
-        self._request_id = None
-        self._check_response = False
+        for timeout in self._request_timeouts.itervalues():
+            IOLoop.instance().remove_timeout(timeout)
+
+        self._requests = {}
+        self._request_timeouts = {}
+        self._streaming_callbacks = {}
+        self._exhaust = {}
+        self._sent_at = {}
+        self._reading = False
 
     @contextlib.contextmanager
     def close_on_error(self):
@@ -164,7 +443,44 @@ class Connection(object):
             self.close()
             raise
 
-    def send_message(self, message, with_last_error=False, callback=None):
+    def _prepare(self):
+        if self._requests and not self._pipelined:
+            raise ProgrammingError('connection already in use')
+
+        if self.closed():
+            if self._autoreconnect:
+                self._connect()
+            else:
+                raise InterfaceError('connection is closed and autoreconnect is false')
+
+    def _add_request(self, request_id, callback, check_response=False,
+                     network_timeout=None, streaming_callback=None,
+                     exhaust=False, event=None):
+        assert not (exhaust and streaming_callback), \
+            "exhaust replies can't be streamed"
+
+        self._requests[request_id] = stack_context.wrap(
+            partial(self._on_response, callback, check_response, event))
+
+        if streaming_callback:
+            self._streaming_callbacks[request_id] = stack_context.wrap(
+                partial(self._on_stream, request_id, streaming_callback))
+
+        if exhaust:
+            self._exhaust[request_id] = network_timeout
+
+        self._sent_at[request_id] = time.time()
+
+        self._add_request_timeout(request_id, network_timeout)
+
+    def _add_request_timeout(self, request_id, network_timeout):
+        if network_timeout:
+            self._request_timeouts[request_id] = IOLoop.instance().add_timeout(
+                timedelta(seconds=network_timeout),
+                partial(self._on_request_timeout, request_id))
+
+    def send_message(self, message, with_last_error=False, callback=None,
+                     network_timeout=None, event=None):
         """Say something to Mongo.
 
         Raises ConnectionFailure if the message cannot be sent. Raises
@@ -177,66 +493,102 @@ class Connection(object):
           - `message`: message to send
           - `with_last_error`: check getLastError status after sending the
             message
+          - `network_timeout` (optional): seconds to wait for the
+            getLastError response before failing with
+            :class:`~mongotor.errors.TimeoutError`
+          - `event` (optional): :class:`~mongotor.monitoring.CommandEvent`
+            of the message, it succeeds once the message is written or
+            the getLastError response is checked
         """
-        if self._callback is not None:
-            raise ProgrammingError('connection already in use')
+        self._prepare()
 
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
+        callback = stack_context.wrap(callback)
 
-        self._callback = stack_context.wrap(callback)
-        self._check_response = with_last_error
+        # only errors sending the message close the connection, not the
+        # ones raised by callbacks
+        with self.close_on_error():
+            self.__send_message(message, with_last_error, callback,
+                                network_timeout, event)
 
-        with stack_context.StackContext(self.close_on_error):
-            self.__send_message(message, with_last_error=with_last_error)
+        if callback and not with_last_error:
+            callback((None, None))
 
-    def __send_message(self, message, with_last_error=False):
+    def __send_message(self, message, with_last_error, callback,
+                       network_timeout=None, event=None):
         self.usage += 1
 
-        (self._request_id, message) = message
+        (request_id, message) = message
 
-        self._stream.write(message)
+        if event:
+            self._command_started(event, request_id, message)
 
         if with_last_error:
-            self._stream.read_bytes(16, callback=self._parse_header)
+            self._add_request(request_id, callback, check_response=True,
+                              network_timeout=network_timeout, event=event)
+
+        self._write(message, event)
+
+        if with_last_error:
+            self._read_reply()
             return
 
-        self.reset()
-        self.release()
+        if not self._requests:
+            self.release()
+
+        monitoring._command_succeeded(event)
 
-        if self._callback:
-            self._callback()
+    def _command_started(self, event, request_id, message):
+        # the time the request waited for this connection in its pool
+        event.pool_wait, self._checkout_wait = self._checkout_wait, 0
+        monitoring._command_started(event, request_id,
+            "{0}:{1}".format(self._host, self._port), len(message))
 
-    def send_message_with_response(self, message, callback):
+    def send_message_with_response(self, message, callback,
+                                   network_timeout=None,
+                                   streaming_callback=None, exhaust=False,
+                                   event=None):
         """Send a message to Mongo and return the response.
 
         Sends the given message and returns the response.
 
         :Parameters:
           - `message`: (request_id, data) pair making up the message to send
+          - `network_timeout` (optional): seconds to wait for the response
+            before failing with :class:`~mongotor.errors.TimeoutError`.
+            A connection which is not pipelined is closed on timeout
+          - `streaming_callback` (optional): called with the chunks of the
+            response body as they arrive, the response given to `callback`
+            is then empty
+          - `exhaust` (optional): the message is a query with the exhaust
+            flag, `callback` is called with each reply until the cursor
+            id of a reply is 0. `network_timeout` applies to each reply
+          - `event` (optional): :class:`~mongotor.monitoring.CommandEvent`
+            of the message, it fails on errors of the connection. The
+            caller decodes the response and reports the event succeeded
         """
-        if self._callback is not None:
-            raise ProgrammingError('connection already in use')
+        self._prepare()
 
-        if self.closed():
-            if self._autoreconnect:
-                self._connect()
-            else:
-                raise InterfaceError('connection is closed and autoreconnect is false')
-
-        self._callback = stack_context.wrap(callback)
-        self._check_response = False
+        callback = stack_context.wrap(callback)
 
-        with stack_context.StackContext(self.close_on_error):
-            self.__send_message_and_receive(message)
+        with self.close_on_error():
+            self.__send_message_and_receive(message, callback, network_timeout,
+                                            streaming_callback, exhaust, event)
 
-    def __send_message_and_receive(self, message):
+    def __send_message_and_receive(self, message, callback,
+                                   network_timeout=None,
+                                   streaming_callback=None, exhaust=False,
+                                   event=None):
         self.usage += 1
 
-        (self._request_id, message) = message
+        (request_id, message) = message
+
+        if event:
+            self._command_started(event, request_id, message)
+
+        self._add_request(request_id, callback,
+                          network_timeout=network_timeout,
+                          streaming_callback=streaming_callback,
+                          exhaust=exhaust, event=event)
 
-        self._stream.write(message)
-        self._stream.read_bytes(16, callback=self._parse_header)
+        self._write(message, event)
+        self._read_reply()
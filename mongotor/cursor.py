@@ -15,16 +15,26 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import time
+from collections import deque
+from datetime import timedelta
+from functools import partial
 from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
 from bson import SON
 from mongotor import message
 from mongotor import helpers
+from mongotor import monitoring
+from mongotor.errors import Error, InterfaceError, InvalidOperationError
 
 _QUERY_OPTIONS = {
     "tailable_cursor": 2,
     "slave_okay": 4,
     "oplog_replay": 8,
-    "no_timeout": 16}
+    "no_timeout": 16,
+    "await_data": 32,
+    "exhaust": 64}
 
 DESCENDING = -1
 ASCENDING = 1
@@ -39,11 +49,18 @@ class Cursor(object):
     def __init__(self, database, collection, spec_or_id=None, fields=None, snapshot=False,
         tailable=False, max_scan=None, is_command=False, explain=False, hint=None,
         skip=0, limit=0, sort=None, connection=None,
-        read_preference=None, timeout=True, slave_okay=True, **kw):
+        read_preference=None, timeout=True, slave_okay=True,
+        network_timeout=None, as_class=dict, tz_aware=False, raw=False,
+        batch_size=0, prefetch=0, prefetch_max_bytes=0, await_data=False,
+        oplog_replay=False, exhaust=False, balancing=None, tag_sets=None,
+        **kw):
 
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
 
+        if exhaust and limit:
+            raise InvalidOperationError("can't use limit and exhaust together")
+
         self._spec = spec_or_id or {}
 
         if fields is not None:
@@ -55,45 +72,505 @@ class Cursor(object):
         self._fields = fields
         self._snapshot = snapshot
         self._tailable = tailable
+        self._await_data = await_data
+        self._oplog_replay = oplog_replay
+        self._exhaust = exhaust
+        self._tailing = False
         self._max_scan = max_scan
         self._hint = hint
         self._database = database
         self._collection = collection
         self._collection_name = database.get_collection_name(collection)
         self._timeout = timeout
+        self._network_timeout = network_timeout
+        self._as_class = as_class
+        self._tz_aware = tz_aware
+        self._raw = raw
         self._is_command = is_command
         self._explain = explain
         self._slave_okay = slave_okay
         self._read_preference = read_preference
+        self._balancing = balancing
+        self._tag_sets = tag_sets
         self._connection = connection
         self._ordering = sort
         self._skip = skip
         self._limit = limit
+        self._batch_size = batch_size
+        self._started = False
+        self._exhausted = False
+        self._cursor_id = 0
+        self._retrieved = 0
+        self._pinned_connection = None
+        self._node = None
+        self._prefetch = prefetch
+        self._prefetch_max_bytes = prefetch_max_bytes
+        self._ready = deque()
+        self._ready_bytes = 0
+        self._fetching = 0
+        self._waiting = None
 
-    @gen.engine
-    def find(self, callback=None):
-        message_query = message.query(self._query_options(), self._collection_name,
-            self._skip, self._limit, self._query_spec(), self._fields)
+    @property
+    def alive(self):
+        """Does this cursor have more batches to be retrieved?"""
+        return bool(self._ready) or not self._exhausted
 
+    @gen.engine
+    def _get_connection(self, callback):
         if not self._connection:
-            node = yield gen.Task(self._database.get_node, self._read_preference)
+            node = yield gen.Task(self._database.get_node,
+                self._read_preference, self._balancing, self._tag_sets)
             connection = yield gen.Task(node.connection)
+            self._node = node
         else:
             connection = self._connection
 
-        response, _ = yield gen.Task(connection.send_message_with_response, message_query)
-        response = helpers._unpack_response(response)
+        callback(connection)
 
-        # close cursor
-        if response and response.get('cursor_id'):
-            cursor_id = response['cursor_id']
+    def _num_to_return(self):
+        if self._limit < 0:
+            return self._limit  # a single batch
 
-            connection.send_message(message.kill_cursors([cursor_id]), callback=None)
+        batch_size = self._batch_size
+        if batch_size == 1:
+            batch_size = 2  # 1 would close the cursor after the first batch
 
-        if self._limit == -1 and len(response['data']) == 1:
-            callback((response['data'][0], None))
+        if self._limit:
+            remaining = self._limit - self._retrieved
+            if batch_size:
+                return min(remaining, batch_size)
+            return remaining
+
+        return batch_size
+
+    @gen.engine
+    def _next_reply(self, callback, document_callback=None):
+        """Send the query, or a getMore once the query was sent, and unpack
+        the reply. When `document_callback` is given the documents are
+        streamed to it and the unpacked data is empty.
+        """
+        if not self._started:
+            connection = yield gen.Task(self._start)
+            message_next = self._query_message()
+            event = self._command_event('query')
         else:
-            callback((response['data'], None))
+            connection = self._pinned_connection
+            if not connection:  # an attached cursor
+                connection = yield gen.Task(self._node.connection)
+                connection.pin()
+                self._pinned_connection = connection
+
+            message_next = message.get_more(self._collection_name,
+                self._num_to_return(), self._cursor_id)
+            event = self._command_event('getMore')
+
+        reply = None
+        if document_callback:
+            reply = helpers._StreamingReply(document_callback, self._as_class,
+                self._tz_aware, self._raw)
+
+        response, error = yield gen.Task(connection.send_message_with_response,
+            message_next, network_timeout=self._network_timeout,
+            streaming_callback=reply and reply.feed, event=event)
+        if self._exhausted:
+            # a reply which arrived after the cursor was closed
+            self._close_cursor()
+            if not error:
+                monitoring._command_succeeded(event)
+            callback(({'cursor_id': 0, 'number_returned': 0, 'data': []}, None))
+            return
+
+        if error:
+            self._close_cursor()
+            self._check_error(error)
+            callback((None, error))
+            return
+
+        callback((self._unpack(response, reply, event), None))
+
+    def _check_error(self, error):
+        if self._node:
+            # the node may be down or no longer the primary
+            self._node.check_error(error)
+
+    def _command_event(self, op_type):
+        if self._is_command and op_type == 'query':
+            return monitoring._command_event('command', self._collection_name,
+                next(iter(self._spec), None), spec=self._spec)
+
+        return monitoring._command_event(op_type, self._collection_name,
+            spec=self._spec, batch_size=self._num_to_return())
+
+    def _attach(self, node, cursor_id, documents):
+        """Take over the server cursor `cursor_id` opened by a command,
+        e.g. parallelCollectionScan, on `node` with its first batch of
+        `documents`. A connection to `node` is only taken for the first
+        getMore.
+        """
+        self._started = True
+        self._node = node
+        self._cursor_id = cursor_id
+        self._retrieved = len(documents)
+
+        if documents:
+            self._ready.append(({'cursor_id': cursor_id, 'data': documents,
+                                 'number_returned': len(documents)},
+                                None, False))
+        if not cursor_id:
+            self._close_cursor()
+
+    @gen.engine
+    def _start(self, callback):
+        self._started = True
+
+        connection = yield gen.Task(self._get_connection)
+        connection.pin()
+        self._pinned_connection = connection
+
+        callback(connection)
+
+    def _query_message(self):
+        return message.query(self._query_options(), self._collection_name,
+            self._skip, self._num_to_return(), self._query_spec(), self._fields)
+
+    def _unpack(self, response, reply=None, event=None):
+        size = len(response or "")
+        started = time.time()
+        try:
+            if reply:
+                response = reply.finish(self._cursor_id)
+            else:
+                response = helpers._unpack_response(response, self._cursor_id,
+                    as_class=self._as_class, tz_aware=self._tz_aware, raw=self._raw)
+        except Exception, e:
+            self._cursor_id = 0  # the server cursor is gone
+            self._close_cursor()
+            monitoring._command_failed(event, e)
+            self._check_error(e)
+            raise
+
+        if event:
+            monitoring._command_decoded(event, time.time() - started)
+
+        response['size'] = size
+        self._cursor_id = response['cursor_id']
+        self._retrieved += response['number_returned']
+
+        if not self._cursor_id or self._limit < 0 or \
+                (self._limit and self._retrieved >= self._limit):
+            self._close_cursor()
+
+        if not (self._exhaust and self._cursor_id):
+            # the replies of an exhaust query make a single operation
+            monitoring._command_succeeded(event)
+
+        return response
+
+    @gen.engine
+    def _exhaust_query(self):
+        """Send the query with the exhaust flag, the server then sends
+        every batch without waiting for a getMore.
+        """
+        connection = yield gen.Task(self._start)
+        if connection._pipelined:
+            # the batches would hold up every request sharing the connection
+            self._close_cursor()
+            raise InvalidOperationError("can't use exhaust with a pipelined "
+                                        "connection")
+
+        event = self._command_event('query')
+        connection.send_message_with_response(self._query_message(),
+            callback=partial(self._on_exhaust_reply, event),
+            network_timeout=self._network_timeout, exhaust=True, event=event)
+
+    def _on_exhaust_reply(self, event, result):
+        response, error = result
+        if self._exhausted:
+            # the rest of a stream closed by the application
+            if not error:
+                self._cursor_id = helpers._reply_cursor_id(response)
+            self._close_cursor()
+            return
+
+        if error:
+            self._fetching -= 1
+            self._close_cursor()
+            self._check_error(error)
+            self._on_fetched((None, error, False))
+            return
+
+        response = self._unpack(response, event=event)
+        if self._exhausted:
+            self._fetching -= 1
+
+        self._on_fetched((response, None, False))
+
+    def _can_prefetch(self):
+        if self._exhaust or self._exhausted or not self._cursor_id or \
+                len(self._ready) + self._fetching >= self._prefetch or \
+                (self._prefetch_max_bytes and
+                 self._ready_bytes >= self._prefetch_max_bytes):
+            return False
+
+        # many getMore in flight need a pipelined connection, and a limit
+        # must know how many documents the last reply brought
+        connection = self._pinned_connection
+        return not self._fetching or (connection and connection._pipelined and
+                                      not self._limit)
+
+    def _prefetch_batches(self):
+        while self._can_prefetch():
+            self._fetch()
+
+    def _fetch(self):
+        self._fetching += 1
+        with stack_context.ExceptionStackContext(self._on_fetch_error):
+            if self._exhaust:
+                self._exhaust_query()
+            else:
+                self._next_reply(callback=self._on_fetch)
+
+    def _on_fetch_error(self, type, value, traceback):
+        self._fetching -= 1
+        self._on_fetched((None, value, True))
+        return True
+
+    def _on_fetch(self, result):
+        self._fetching -= 1
+        response, error = result
+        self._on_fetched((response, error, False))
+
+    def _on_fetched(self, result):
+        if self._waiting:
+            deliver, self._waiting = self._waiting, None
+            deliver(result)
+            return
+
+        response = result[0]
+        if response is not None and not response['data'] and \
+                not response['number_returned']:
+            return  # nothing worth keeping
+
+        self._ready.append(result)
+        self._ready_bytes += response and response.get('size', 0) or 0
+
+        if response is not None:
+            # one batch at a time unless the connection is pipelined
+            self._prefetch_batches()
+
+    def _deliver(self, result, callback):
+        response, error, raised = result
+        if raised:
+            raise error
+
+        if error:
+            callback((None, error))
+            return
+
+        # get the next batches while the application handles this one
+        self._prefetch_batches()
+
+        callback((response['data'], None))
+
+    def next_batch(self, callback):
+        """Get the next batch of documents of this cursor, the first call
+        sends the query and the next ones get more documents from the
+        server cursor.
+
+        The connection used by the query is kept by the cursor until all
+        documents were retrieved or :meth:`close` is called.
+
+        :Parameters:
+          - `callback`: called with a ``(documents, error)`` tuple,
+            `documents` is an empty list when the cursor is exhausted
+        """
+        assert not self._waiting, "a batch is already being waited for"
+
+        if self._ready:
+            result = self._ready.popleft()
+            self._ready_bytes -= result[0] and result[0].get('size', 0) or 0
+            self._deliver(result, callback)
+            return
+
+        if self._exhausted and not self._fetching:
+            callback(([], None))
+            return
+
+        self._waiting = stack_context.wrap(partial(self._deliver,
+                                                   callback=callback))
+        if not self._fetching:
+            self._fetch()
+
+    @gen.engine
+    def each(self, callback):
+        """Iterate over all documents of this cursor, batch by batch.
+
+        :Parameters:
+          - `callback`: called with a ``(document, error)`` tuple for each
+            document found and with ``(None, None)`` when the cursor is
+            exhausted
+        """
+        while True:
+            documents, error = yield gen.Task(self.next_batch)
+            if error:
+                callback((None, error))
+                return
+
+            for document in documents:
+                callback((document, None))
+
+            if not self.alive:
+                break
+
+        callback((None, None))
+
+    @gen.engine
+    def find(self, callback=None):
+        documents = []
+        while True:
+            batch, error = yield gen.Task(self.next_batch)
+            if error:
+                callback((None, error))
+                return
+
+            documents.extend(batch)
+            if not self.alive:
+                break
+
+        if self._limit == -1 and len(documents) == 1:
+            callback((documents[0], None))
+        else:
+            callback((documents, None))
+
+    @gen.engine
+    def stream(self, document_callback, callback=None):
+        """Find documents, handing each one to `document_callback` as soon
+        as its bytes are read from the socket instead of waiting for the
+        whole reply.
+
+        :Parameters:
+          - `document_callback`: called with each document found
+          - `callback` (optional): called with the number of documents
+            found when the cursor is exhausted
+        """
+        assert not self._exhaust, "exhaust replies can't be streamed"
+
+        count = 0
+        while not self._exhausted:
+            response, error = yield gen.Task(self._next_reply,
+                document_callback=document_callback)
+            if error:
+                if callback:
+                    callback((None, error))
+                return
+
+            count += response['number_returned']
+
+        if callback:
+            callback((count, None))
+
+    @gen.engine
+    def tail(self, callback, resume_delay=1):
+        """Follow a tailable cursor, handing each new document to
+        `callback` until :meth:`close` is called.
+
+        When the server cursor dies, because the collection was empty,
+        the cursor fell behind a capped collection or the connection
+        failed, the query is sent again after `resume_delay` seconds,
+        resuming after the last document seen: by ``ts`` for
+        `oplog_replay` queries and by ``_id`` otherwise.
+
+        :Parameters:
+          - `callback`: called with a ``(document, None)`` tuple for each
+            document
+          - `resume_delay` (optional): seconds to wait before sending
+            the query again, and between getMore of cursors without
+            `await_data`
+        """
+        assert self._tailable, "only tailable cursors can be tailed"
+
+        resume_key = self._oplog_replay and 'ts' or '_id'
+        self._tailing = True
+
+        while self._tailing:
+            try:
+                documents, error = yield gen.Task(self.next_batch)
+            except Error, e:
+                documents, error = [], e
+
+            if error:
+                logger.warn('tailable cursor on {0} failed: {1}'.format(
+                    self._collection_name, error))
+
+            for document in documents:
+                if resume_key in document:
+                    self._resume_after(resume_key, document[resume_key])
+                callback((document, None))
+
+            if not self._tailing or (documents and self.alive):
+                continue
+
+            if self.alive and self._await_data:
+                continue  # the server already waited for new documents
+
+            yield gen.Task(IOLoop.instance().add_timeout,
+                           timedelta(seconds=resume_delay))
+
+            if self._tailing and not self.alive:
+                self._restart()
+
+    def _resume_after(self, key, value):
+        spec = SON(self._spec)
+        spec[key] = {'$gt': value}
+        self._spec = spec
+
+    def _restart(self):
+        self._close_cursor()
+        self._started = self._exhausted = False
+        self._retrieved = 0
+
+    def close(self):
+        """Close this cursor, killing the server cursor if it's alive and
+        giving the connection back to its pool.
+        """
+        self._tailing = False
+        self._ready.clear()
+        self._ready_bytes = 0
+        self._close_cursor()
+
+    def _close_cursor(self):
+        self._exhausted = True
+
+        connection = self._pinned_connection
+        if not connection and not (self._node and self._cursor_id):
+            return
+
+        if not self._node and connection.in_flight and \
+                not connection._pipelined:
+            return  # killed when the reply in flight arrives
+
+        self._pinned_connection = None
+
+        cursor_id, self._cursor_id = self._cursor_id, 0
+        if cursor_id and self._node:
+            # killed along with other abandoned cursors of the node
+            self._node.kill_cursors([cursor_id])
+        elif cursor_id:
+            try:
+                connection.send_message(message.kill_cursors([cursor_id]),
+                    callback=None, event=monitoring._command_event(
+                        'killCursors', self._collection_name))
+            except InterfaceError, ie:
+                logger.error('could not kill cursor {0}: {1}'.format(cursor_id, ie))
+
+        if connection:
+            connection.unpin()
+
+    def __del__(self):
+        if getattr(self, '_pinned_connection', None) or \
+                getattr(self, '_cursor_id', 0):
+            # an abandoned cursor, its connection goes back to the pool
+            self._close_cursor()
 
     @gen.engine
     def count(self, callback):
@@ -142,6 +619,12 @@ class Cursor(object):
             options |= _QUERY_OPTIONS["slave_okay"]
         if not self._timeout:
             options |= _QUERY_OPTIONS["no_timeout"]
+        if self._tailable and self._await_data:
+            options |= _QUERY_OPTIONS["await_data"]
+        if self._oplog_replay:
+            options |= _QUERY_OPTIONS["oplog_replay"]
+        if self._exhaust:
+            options |= _QUERY_OPTIONS["exhaust"]
         return options
 
     def _query_spec(self):
@@ -160,3 +643,43 @@ class Cursor(object):
         if self._max_scan:
             spec["$maxScan"] = self._max_scan
         return spec
+
+
+class _MergedCursors(object):
+    """Iterate over many cursors at the same time, handing the documents
+    of all of them to a single callback as they arrive.
+    """
+
+    def __init__(self, cursors, callback):
+        self._cursors = cursors
+        self._callback = callback
+        self._running = len(cursors)
+        self._failed = False
+
+    def each(self):
+        if not self._cursors:
+            self._callback((None, None))
+            return
+
+        for cursor in self._cursors:
+            cursor.each(callback=self._on_document)
+
+    def _on_document(self, result):
+        document, error = result
+        if self._failed:
+            return
+
+        if error:
+            self._failed = True
+            for cursor in self._cursors:
+                cursor.close()
+            self._callback((None, error))
+            return
+
+        if document is None:
+            self._running -= 1
+            if not self._running:
+                self._callback((None, None))
+            return
+
+        self._callback((document, None))
@@ -18,12 +18,18 @@
 from functools import partial, wraps
 from datetime import timedelta
 from tornado import gen
+from tornado import stack_context
 from tornado.ioloop import IOLoop
 from bson import SON
-from mongotor.node import Node, ReadPreference
+from mongotor.node import Node, ReadPreference, Balancing
 from mongotor.errors import DatabaseError
 from mongotor.client import Client
+from mongotor import monitoring
 import warnings
+import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def initialized(fn):
@@ -57,14 +63,54 @@ class Database(object):
         >>> db.collection.insert({...}, callback=...)
 
         :Parameters:
-          - `addresses` : addresses can be a list or a simple string, host:port
+          - `addresses` : addresses can be a list or a simple string, host:port.
+            The other members of a replica set are discovered from them
           - `dbname` : mongo database name
           - `read_preference` (optional): The read preference for
             this query.
+          - `minconnections` (optional): connections of each pool opened in
+            background after init. default is 0
           - `maxconnections` (optional): maximum open connections for pool. 0 for unlimited
           - `maxusage` (optional): number of requests allowed on a connection
             before it is closed. 0 for unlimited
           - `autoreconnect`: autoreconnect to database. default is True
+          - `connect_timeout` (optional): seconds to wait for a connection
+            to be stabilished. default is 5
+          - `pipelined` (optional): send concurrent requests over shared
+            connections, matching replies by request id. default is False
+          - `coalesce_writes` (optional): write the messages sent on a
+            connection during an ioloop iteration at once. default is False
+          - `wait_queue_timeout` (optional): seconds to wait for a
+            connection when `maxconnections` are in use. default is 1
+          - `wait_queue_size` (optional): maximum requests waiting for a
+            connection. 0 for unlimited, the default
+          - `max_idle_time` (optional): seconds an idle connection above
+            `minconnections` is kept open. 0 for unlimited, the default
+          - `max_lifetime` (optional): seconds a connection is used before
+            being replaced, less a random jitter. 0 for unlimited, the
+            default
+          - `adaptive` (optional): a
+            :class:`~mongotor.pool.AdaptivePoolSize` resizing the pools
+            with the load, between `minconnections` and `maxconnections`
+          - `kill_cursors_delay` (optional): seconds to collect abandoned
+            cursors of a node before killing them with a single message.
+            default is 1
+          - `latency_window` (optional): seconds of ping time above the
+            nearest node within which the nodes share the reads which may
+            go to secondaries. default is 0.015
+          - `balancing` (optional): how the reads are balanced among the
+            nodes they may go to, a :class:`~mongotor.node.Balancing`.
+            default is ``Balancing.RANDOM``
+          - `tag_sets` (optional): the tag sets of the nodes the reads
+            which may go to secondaries are sent to, see
+            :class:`~mongotor.node.ReadPreference`
+          - `heartbeat_frequency` (optional): seconds between the checks
+            of the state of the nodes. default is 30
+          - `min_heartbeat_frequency` (optional): seconds between the
+            checks while there is no primary, e.g. during an election, and
+            minimum delay of the checks made when an operation fails
+            because a node is unreachable or no longer the primary.
+            default is 0.5
         """
         if cls._instance and hasattr(cls._instance, '_initialized') and cls._instance._initialized:
             return cls._instance
@@ -79,9 +125,20 @@ class Database(object):
         self._dbname = dbname
         self._read_preference = read_preference or ReadPreference.PRIMARY
         self._nodes = []
+        self._latency_window = kwargs.pop('latency_window', 0.015)
+        self._balancing = kwargs.pop('balancing', Balancing.RANDOM)
+        self._tag_sets = kwargs.pop('tag_sets', None)
+        self._heartbeat_frequency = kwargs.pop('heartbeat_frequency', 30)
+        self._min_heartbeat_frequency = kwargs.pop('min_heartbeat_frequency', 0.5)
+        self._checking = 0
+        self._checked_at = 0
+        self._primary_rechecked = False
+        self._check_timeout = None
+        self._check_deadline = None
         self._pool_kwargs = kwargs
         self._initialized = True
         self._connected = False
+        self._closed = False
         self._connect_callbacks = []
 
         for host, port in self._addresses:
@@ -96,15 +153,66 @@ class Database(object):
         assert not self._connected
         self._connect_callbacks.append(callback)
         if len(self._connect_callbacks) == 1:  # if another _connect is not in progress
-            self._config_nodes(callback=self._on_config_node)
+            self._config_nodes()
+
+    def _config_nodes(self):
+        """Check the state of the nodes, the next check is scheduled once
+        all of them answered.
+        """
+        self._remove_check_timeout()
+        if self._checking or self._closed:
+            return
 
-    def _config_nodes(self, callback=None):
+        self._checking = len(self._nodes)
+        self._checked_at = time.time()
+        self._primary_rechecked = False
         for node in self._nodes:
-            node.config(callback)
+            node.config(self._on_config_node)
+
+    def _request_check(self):
+        """Check the nodes as soon as `min_heartbeat_frequency` allows"""
+        if self._checking:
+            return
+
+        delay = self._checked_at + self._min_heartbeat_frequency - time.time()
+        self._schedule_check(max(delay, 0))
 
-        IOLoop.instance().add_timeout(timedelta(seconds=30), self._config_nodes)
+    def _schedule_check(self, delay):
+        if self._closed:
+            return
+
+        deadline = time.time() + delay
+        if self._check_timeout and self._check_deadline <= deadline:
+            return
+
+        self._remove_check_timeout()
+        self._check_deadline = deadline
+        with stack_context.NullContext():
+            self._check_timeout = IOLoop.instance().add_timeout(
+                timedelta(seconds=delay), self._config_nodes)
+
+    def _remove_check_timeout(self):
+        if self._check_timeout:
+            IOLoop.instance().remove_timeout(self._check_timeout)
+            self._check_timeout = None
 
     def _on_config_node(self):
+        self._checking -= 1
+        if self._closed:
+            return  # a check answered after the database was disconnected
+
+        if not self._checking:
+            if self._discover_nodes():
+                # the new nodes, maybe the primary, are checked at once
+                self._schedule_check(0)
+            # checked sooner while there is no primary, e.g. in an election
+            elif ReadPreference.select_primary_node(self._nodes):
+                self._schedule_check(self._heartbeat_frequency)
+            elif self._check_reported_primary():
+                return  # connected once the primary answered
+            else:
+                self._schedule_check(self._min_heartbeat_frequency)
+
         for node in self._nodes:
             if not node.initialized:
                 return
@@ -114,6 +222,70 @@ class Database(object):
             IOLoop.instance().add_callback(callback)
         self._connect_callbacks = []
 
+    def _check_reported_primary(self):
+        """Check again the node the others report as the primary, e.g.
+        elected after it was checked, once per check of the nodes.
+
+        Returns whether it is checked.
+        """
+        if self._primary_rechecked:
+            return False
+
+        reported = set(node.primary_address for node in self._nodes
+                       if node.available and node.primary_address)
+        for node in self._nodes:
+            if '{0}:{1}'.format(node.host, node.port) in reported:
+                self._primary_rechecked = True
+                self._checking += 1
+                node.config(self._on_config_node)
+                return True
+
+        return False
+
+    def _discover_nodes(self):
+        """Add a node for each new member reported by the nodes and, when
+        the primary lists the members, remove the nodes it doesn't list.
+
+        Returns whether nodes were added.
+        """
+        if self._closed:
+            return False
+
+        primary = ReadPreference.select_primary_node(self._nodes)
+        if primary and primary.members:
+            members = set(primary.members)
+        else:
+            members = set()
+            for node in self._nodes:
+                if node.available:
+                    members.update(node.members)
+
+        known = dict(('{0}:{1}'.format(node.host, node.port), node)
+                     for node in self._nodes)
+
+        added = members.difference(known)
+        for host, port in self._parse_addresses(sorted(added)):
+            node = Node(host, port, self, self._pool_kwargs)
+            self._nodes.append(node)
+            logger.info('discovered node {0}:{1}'.format(host, port))
+            if monitoring._topology_listeners:
+                monitoring._publish(monitoring._topology_listeners,
+                                    'node_added', node)
+
+        if primary and primary.members:
+            for address, node in known.iteritems():
+                if address in members:
+                    continue
+
+                self._nodes.remove(node)
+                node.disconnect()
+                logger.info('removed node {0}'.format(address))
+                if monitoring._topology_listeners:
+                    monitoring._publish(monitoring._topology_listeners,
+                                        'node_removed', node)
+
+        return bool(added)
+
     @property
     def dbname(self):
         return self._dbname
@@ -155,11 +327,37 @@ class Database(object):
         if not cls._instance or not hasattr(cls._instance, '_initialized'):
             raise ValueError("Database isn't initialized")
 
+        cls._instance._closed = True
+        cls._instance._remove_check_timeout()
         for node in cls._instance._nodes:
             node.disconnect()
 
         cls._instance = None
 
+    @initialized
+    def stats(self):
+        """Get the state of each node and its connection pool.
+
+        >>> Database().stats()['localhost:27017']['pool']['in_use']
+        2
+
+        Returns a dict of ``host:port`` to a dict with the ``primary``,
+        ``secondary`` and ``available`` state of the node, its
+        ``ping_time`` and the :meth:`~mongotor.pool.ConnectionPool.stats`
+        of its ``pool``.
+        """
+        stats = {}
+        for node in self._nodes:
+            stats['{0}:{1}'.format(node.host, node.port)] = {
+                'primary': node.is_primary,
+                'secondary': node.is_secondary,
+                'available': node.available,
+                'ping_time': node.ping_time,
+                'pool': node.pool.stats(),
+            }
+
+        return stats
+
     @gen.engine
     @initialized
     def send_message(self, message, read_preference=None,
@@ -167,15 +365,24 @@ class Database(object):
         node = yield gen.Task(self.get_node, read_preference)
 
         connection = yield gen.Task(node.connection)
+        event = monitoring._message_event(message[1])
 
-        if with_response:
-            connection.send_message_with_response(message, callback=callback)
-        else:
-            connection.send_message(message, callback=callback)
+        if not with_response:
+            connection.send_message(message, callback=callback, event=event)
+            return
+
+        response, error = yield gen.Task(connection.send_message_with_response,
+                                         message, event=event)
+        if not error:
+            monitoring._command_succeeded(event)
+
+        if callback:
+            callback((response, error))
 
     @gen.engine
     @initialized
-    def get_node(self, read_preference=None, callback=None):
+    def get_node(self, read_preference=None, balancing=None, tag_sets=None,
+                 callback=None):
         assert callback
 
         # check if database is connected
@@ -186,7 +393,14 @@ class Database(object):
         if read_preference is None:
             read_preference = self._read_preference
 
-        node = ReadPreference.select_node(self._nodes, read_preference)
+        if balancing is None:
+            balancing = self._balancing
+
+        if tag_sets is None:
+            tag_sets = self._tag_sets
+
+        node = ReadPreference.select_node(self._nodes, read_preference,
+            self._latency_window, balancing, tag_sets)
         if not node:
             raise DatabaseError('could not find an available node')
 
@@ -194,7 +408,9 @@ class Database(object):
 
     @initialized
     def command(self, command, value=1, read_preference=None,
-                callback=None, check=True, allowable_errors=[], **kwargs):
+                callback=None, check=True, allowable_errors=[],
+                network_timeout=None, balancing=None, tag_sets=None,
+                **kwargs):
         """Issue a MongoDB command.
 
         Send command `command` to the database and return the
@@ -233,6 +449,13 @@ class Database(object):
 
           - `value` (optional): value to use for the command verb when
             `command` is passed as a string
+          - `network_timeout` (optional): seconds to wait for the
+            response before failing with
+            :class:`~mongotor.errors.TimeoutError`
+          - `balancing` (optional): a :class:`~mongotor.node.Balancing`
+            overriding the one of the database
+          - `tag_sets` (optional): tag sets of the nodes the command may
+            be sent to, overriding the ones of the database
           - `**kwargs` (optional): additional keyword arguments will
             be added to the command document before it is sent
 
@@ -245,10 +468,13 @@ class Database(object):
         if read_preference is None:
             read_preference = self._read_preference
 
-        self._command(command, read_preference=read_preference, callback=callback)
+        self._command(command, read_preference=read_preference,
+                      network_timeout=network_timeout, balancing=balancing,
+                      tag_sets=tag_sets, callback=callback)
 
     def _command(self, command, read_preference=None,
-                 connection=None, callback=None):
+                 connection=None, network_timeout=None, balancing=None,
+                 tag_sets=None, callback=None):
 
         if read_preference is None:
             read_preference = self._read_preference
@@ -256,7 +482,8 @@ class Database(object):
         client = Client(self, '$cmd')
 
         client.find_one(command, is_command=True, connection=connection,
-            read_preference=read_preference, callback=callback)
+            read_preference=read_preference, network_timeout=network_timeout,
+            balancing=balancing, tag_sets=tag_sets, callback=callback)
 
     def __getattr__(self, name):
         """Get a client collection by name.
@@ -56,6 +56,12 @@ class IntegrityError(DatabaseError):
         self.msg = msg
 
 
+class NotMasterError(DatabaseError):
+    """Raised when an operation reaches a node which is no longer the
+    primary.
+    """
+
+
 class ProgrammingError(DatabaseError):
     pass
 
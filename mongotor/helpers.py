@@ -13,12 +13,75 @@
 # limitations under the License.
 
 import bson
+import bson.errors
+import calendar
 import struct
+from datetime import datetime
+from bson.objectid import ObjectId
 from mongotor.errors import (DatabaseError,
-    InterfaceError, TimeoutError)
+    InterfaceError, TimeoutError, NotMasterError)
+from mongotor.raw_bson import RawBSONDocument
 
+# replies larger than this are decoded in slices of about this size, so
+# the body is never copied as a whole when the decoder can't read from a
+# buffer
+_DECODE_COPY_LIMIT = 1024 * 1024
 
-def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
+
+def _decoder_supports_buffers():
+    try:
+        bson.decode_all(memoryview(bson.BSON.encode({})))
+    except Exception:
+        return False
+    return True
+
+_DECODE_BUFFERS = _decoder_supports_buffers()
+
+
+def _decode_documents(data, offset=0, as_class=dict, tz_aware=False):
+    """Decode the BSON documents found in `data` starting at `offset`,
+    without copying the documents' bytes as a whole.
+    """
+    if _DECODE_BUFFERS:
+        return bson.decode_all(memoryview(data)[offset:], as_class, tz_aware)
+
+    if len(data) - offset <= _DECODE_COPY_LIMIT:
+        return bson.decode_all(data[offset:], as_class, tz_aware)
+
+    documents = []
+    end = len(data)
+    while offset < end:
+        # whole documents up to about _DECODE_COPY_LIMIT bytes
+        start = offset
+        while offset < end and offset - start < _DECODE_COPY_LIMIT:
+            size = struct.unpack_from("<i", data, offset)[0]
+            if size < 5:
+                raise bson.errors.InvalidBSON("bad document size")
+            offset += size
+
+        documents.extend(bson.decode_all(data[start:offset], as_class,
+                                         tz_aware))
+
+    return documents
+
+
+def _raw_documents(data, offset=0, as_class=dict, tz_aware=False):
+    """Split the BSON documents found in `data` starting at `offset`
+    without decoding them.
+    """
+    documents = []
+    end = len(data)
+    while offset < end:
+        size = struct.unpack_from("<i", data, offset)[0]
+        documents.append(RawBSONDocument(data[offset:offset + size],
+                                         as_class, tz_aware))
+        offset += size
+
+    return documents
+
+
+def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False,
+                     raw=False):
     """Unpack a response from the database.
 
     Check the response for errors and unpack, returning a dictionary
@@ -30,8 +93,12 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
         used for raising an informative exception when we get cursor id not
         valid at server response
       - `as_class` (optional): class to use for resulting documents
+      - `tz_aware` (optional): decode dates as timezone aware datetimes
+      - `raw` (optional): return documents as
+        :class:`~mongotor.raw_bson.RawBSONDocument`, decoded on first access
     """
-    response_flag = struct.unpack("<i", response[:4])[0]
+    response_flag, response_cursor_id, starting_from, number_returned = \
+        struct.unpack_from("<iqii", response)
     if response_flag & 1:
         # Shouldn't get this response if we aren't doing a getMore
         assert cursor_id is not None
@@ -39,21 +106,126 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
         raise InterfaceError("cursor id '%s' not valid at server" %
                                cursor_id)
     elif response_flag & 2:
-        error_object = bson.BSON(response[20:]).decode()
-        if error_object["$err"] == "not master":
-            raise DatabaseError("master has changed")
+        error_object = _decode_documents(response, 20)[0]
+        if error_object["$err"].startswith("not master"):
+            raise NotMasterError("master has changed")
         raise DatabaseError("database error: %s" %
                                error_object["$err"])
 
     result = {}
-    result["cursor_id"] = struct.unpack("<q", response[4:12])[0]
-    result["starting_from"] = struct.unpack("<i", response[12:16])[0]
-    result["number_returned"] = struct.unpack("<i", response[16:20])[0]
-    result["data"] = bson.decode_all(response[20:], as_class, tz_aware)
+    result["cursor_id"] = response_cursor_id
+    result["starting_from"] = starting_from
+    result["number_returned"] = number_returned
+    if raw:
+        result["data"] = _raw_documents(response, 20, as_class, tz_aware)
+    else:
+        result["data"] = _decode_documents(response, 20, as_class, tz_aware)
     assert len(result["data"]) == result["number_returned"]
     return result
 
 
+def _reply_cursor_id(response):
+    """Get the cursor id of a reply body without unpacking its documents,
+    0 when the reply is too short to hold one.
+    """
+    if len(response) < 12:
+        return 0
+    return struct.unpack_from("<q", response, 4)[0]
+
+
+class _StreamingReply(object):
+    """Incremental parser of an OP_REPLY body.
+
+    Documents are handed to `document_callback` as soon as their bytes
+    were fed, so about one document and one read chunk are buffered.
+
+    :Parameters:
+      - `document_callback`: called with each document of the reply
+      - `as_class` (optional): class to use for resulting documents
+      - `tz_aware` (optional): decode dates as timezone aware datetimes
+      - `raw` (optional): hand documents as
+        :class:`~mongotor.raw_bson.RawBSONDocument`
+    """
+
+    def __init__(self, document_callback, as_class=dict, tz_aware=False,
+                 raw=False):
+        self._document_callback = document_callback
+        self._as_class = as_class
+        self._tz_aware = tz_aware
+        self._raw = raw
+        self._header = None
+        # the chunks are only joined once the bytes `_needed` arrived,
+        # the header or the next document
+        self._chunks = []
+        self._buffered = 0
+        self._needed = 20
+        self.count = 0
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._needed is None or self._buffered < self._needed:
+            return
+
+        buf = "".join(self._chunks)
+        offset = 0
+
+        if self._header is None:
+            self._header = struct.unpack_from("<iqii", buf)
+            offset = 20
+
+            if self._header[0] & 3:
+                # error replies are unpacked when finished
+                self._chunks = [buf[offset:]]
+                self._buffered -= offset
+                self._needed = None
+                return
+
+        while len(buf) - offset >= 4:
+            size = struct.unpack_from("<i", buf, offset)[0]
+            if len(buf) - offset < size:
+                break
+
+            if self._raw:
+                document = RawBSONDocument(buf[offset:offset + size],
+                                           self._as_class, self._tz_aware)
+            else:
+                document = bson.BSON(buf[offset:offset + size]) \
+                    .decode(self._as_class, self._tz_aware)
+
+            offset += size
+            self.count += 1
+            self._document_callback(document)
+
+        rest = buf[offset:]
+        self._chunks = rest and [rest] or []
+        self._buffered = len(rest)
+        if len(rest) >= 4:
+            self._needed = struct.unpack_from("<i", rest)[0]
+        else:
+            self._needed = 4
+
+    def finish(self, cursor_id=None):
+        """Unpack the reply as :func:`_unpack_response` does, its data holds
+        no documents since they were given to the callback.
+        """
+        if self._header is None:
+            raise InterfaceError("incomplete reply")
+
+        response_flag, response_cursor_id, starting_from, number_returned = \
+            self._header
+        if response_flag & 3:
+            _unpack_response(struct.pack("<iqii", *self._header) +
+                             "".join(self._chunks), cursor_id)
+
+        assert not self._buffered and self.count == number_returned
+
+        return {"cursor_id": response_cursor_id,
+                "starting_from": starting_from,
+                "number_returned": number_returned,
+                "data": []}
+
+
 def _check_command_response(response, msg="%s", allowable_errors=[]):
 
     if not response["ok"]:
@@ -97,3 +269,30 @@ def _fields_list_to_dict(fields):
                             "each an instance of %s" % (basestring.__name__,))
         as_dict[field] = 1
     return as_dict
+
+
+def _split_range(lower, upper, parts):
+    """Split the range of `_id` values between `lower` and `upper` into at
+    most `parts` ranges, returning the sorted values which bound them.
+
+    Only numbers and ObjectIds, by their generation time, can be split,
+    other values give no bounds and so a single range.
+    """
+    if isinstance(lower, ObjectId) and isinstance(upper, ObjectId):
+        start = calendar.timegm(lower.generation_time.timetuple())
+        end = calendar.timegm(upper.generation_time.timetuple())
+        return [ObjectId.from_datetime(datetime.utcfromtimestamp(bound))
+                for bound in _split_range(start, end, parts)]
+
+    numbers = (int, long, float)
+    if not isinstance(lower, numbers) or isinstance(lower, bool) or \
+            not isinstance(upper, numbers) or isinstance(upper, bool):
+        return []
+
+    bounds = set()
+    for part in range(1, parts):
+        bound = lower + (upper - lower) * part / parts
+        if lower < bound <= upper:
+            bounds.add(bound)
+
+    return sorted(bounds)
@@ -0,0 +1,340 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Listeners of the events of mongotor.
+
+>>> class LoggingListener(monitoring.PoolListener):
+...     def connection_closed(self, pool, connection, reason):
+...         logging.info('{0} closed: {1}'.format(connection, reason))
+>>> monitoring.register(LoggingListener())
+
+Command listeners get a :class:`CommandEvent` for each message sent to
+the database by collections, cursors and commands.
+:class:`SlowOperationLog` is a command listener keeping the slow
+operations:
+
+>>> slow_operations = monitoring.SlowOperationLog(threshold=0.05)
+>>> monitoring.register(slow_operations)
+
+Topology listeners are told when the state of a node changes.
+"""
+import logging
+import random
+import struct
+import time
+from collections import deque
+import bson
+from bson.son import SON
+
+logger = logging.getLogger(__name__)
+
+_OP_TYPES = {2001: 'update', 2002: 'insert', 2004: 'query', 2005: 'getMore',
+             2006: 'delete', 2007: 'killCursors'}
+
+_pool_listeners = []
+_command_listeners = []
+_topology_listeners = []
+
+
+class PoolListener(object):
+    """Base class of the listeners of connection pool events, its methods
+    do nothing and are overridden by the events of interest.
+    """
+
+    def connection_created(self, pool, connection):
+        """A connection was opened by `pool`"""
+
+    def connection_closed(self, pool, connection, reason):
+        """A connection of `pool` was closed, `reason` is one of
+        ``maxusage``, ``lifetime``, ``idle``, ``shrink``, ``error`` or
+        ``pool closed``.
+        """
+
+    def connection_checked_out(self, pool, connection, waited):
+        """`connection` was handed by `pool` to a request which waited
+        `waited` seconds for it.
+        """
+
+    def connection_checked_in(self, pool, connection):
+        """`connection` was given back to `pool`"""
+
+    def pool_resized(self, pool, old_size, new_size):
+        """An adaptive `pool` changed its size"""
+
+
+class CommandListener(object):
+    """Base class of the listeners of the messages sent to the database,
+    its methods do nothing and are overridden by the events of interest.
+    """
+
+    def started(self, event):
+        """The message of `event` was written to a connection"""
+
+    def succeeded(self, event):
+        """The reply of `event` was received and decoded, or the message
+        was written when no reply is expected.
+        """
+
+    def failed(self, event):
+        """The operation of `event` failed with `event.error`"""
+
+
+class TopologyListener(object):
+    """Base class of the listeners of the changes of the nodes, its
+    methods do nothing and are overridden by the events of interest.
+    """
+
+    def node_changed(self, node, old_state, new_state):
+        """The state of `node` changed, a state is one of ``unknown``,
+        ``unavailable``, ``primary``, ``secondary``, ``arbiter`` or
+        ``other``.
+        """
+
+    def node_added(self, node):
+        """`node` was discovered in the replica set"""
+
+    def node_removed(self, node):
+        """`node` is no longer a member of the replica set"""
+
+
+class CommandEvent(object):
+    """A message sent to the database.
+
+    `op_type` is one of ``insert``, ``update``, ``delete``, ``query``,
+    ``getMore``, ``command`` or ``killCursors``, `command_name` the name
+    of the command for ``command``. The `namespace` of a ``killCursors``
+    sent for the cursors of many collections is None. `spec` is the
+    query, or the command, of the operation and `batch_size` the number
+    of documents asked for or inserted.
+
+    `request_id`, `node` ("host:port"), `payload_size` and `pool_wait`,
+    the seconds the operation waited for a connection, are set when the
+    message is handed to its connection.
+
+    `send_time` is the seconds until the message was written to the
+    socket, `reply_size` the size in bytes of the reply, `round_trip`
+    the seconds between writing the message and reading its reply and
+    `decode_time` the seconds spent decoding it. They are None when
+    there is no reply. The replies of an exhaust query add up.
+    """
+
+    def __init__(self, op_type, namespace, command_name=None, spec=None,
+                 batch_size=None):
+        self.op_type = op_type
+        self.namespace = namespace
+        self.command_name = command_name
+        self.spec = spec
+        self.batch_size = batch_size
+        self.request_id = None
+        self.node = None
+        self.payload_size = None
+        self.pool_wait = 0
+        self.send_time = None
+        self.reply_size = None
+        self.round_trip = None
+        self.decode_time = None
+        self.error = None
+        self._sent_at = None
+        self._written_at = None
+
+    @property
+    def duration(self):
+        """Seconds spent by the operation, from waiting for a connection
+        to decoding the reply.
+        """
+        return sum(seconds for seconds in (self.pool_wait, self.send_time,
+                   self.round_trip, self.decode_time) if seconds)
+
+    def __repr__(self):
+        return "CommandEvent({0} {1} {2})".format(self.op_type,
+            self.namespace, self.request_id)
+
+
+class SlowOperationLog(CommandListener):
+    """Command listener keeping the operations slower than `threshold`
+    seconds, and a sample of the others, in a ring buffer. Slow
+    operations are logged as warnings, sampled ones as debug messages.
+
+    The values of the queries are redacted, only their shape is kept.
+
+    :Parameters:
+      - `threshold` (optional): seconds above which an operation is slow
+      - `sample_rate` (optional): fraction, between 0 and 1, of the other
+        operations which are kept
+      - `size` (optional): number of operations kept, the oldest are
+        dropped
+      - `logger` (optional): logger of the operations, the
+        ``mongotor.slow`` logger by default
+    """
+
+    def __init__(self, threshold=0.1, sample_rate=0, size=100, logger=None):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.operations = deque(maxlen=size)
+        self.logger = logger or logging.getLogger('mongotor.slow')
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        duration = event.duration
+        slow = duration >= self.threshold
+        if not slow and not (self.sample_rate and
+                             random.random() < self.sample_rate):
+            return
+
+        operation = {
+            'time': time.time(),
+            'slow': slow,
+            'op_type': event.op_type,
+            'namespace': event.namespace,
+            'command_name': event.command_name,
+            'shape': _shape(event.spec) if event.spec is not None else None,
+            'node': event.node,
+            'batch_size': event.batch_size,
+            'duration': duration,
+            'pool_wait': event.pool_wait,
+            'send_time': event.send_time,
+            'round_trip': event.round_trip,
+            'decode_time': event.decode_time,
+            'reply_size': event.reply_size,
+            'error': event.error and str(event.error),
+        }
+        self.operations.append(operation)
+
+        if slow:
+            self.logger.warning(_format_operation(operation))
+        elif self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(_format_operation(operation))
+
+
+def _shape(value):
+    """`value` with the values of its documents replaced by ``?``"""
+    if isinstance(value, dict):
+        return dict((key, _shape(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_shape(item) for item in value[:1]]
+    return '?'
+
+
+def _format_operation(operation):
+    return ('{op_type} {namespace} {shape} on {node} took {duration:.6f}s '
+            '(pool wait {pool_wait}, send {send_time}, server {round_trip}, '
+            'decode {decode_time}), batch size {batch_size}'
+            .format(**operation))
+
+
+def register(listener):
+    """Register a listener, a :class:`PoolListener`, a
+    :class:`CommandListener` or a :class:`TopologyListener` instance.
+    """
+    if isinstance(listener, PoolListener):
+        _pool_listeners.append(listener)
+    elif isinstance(listener, CommandListener):
+        _command_listeners.append(listener)
+    elif isinstance(listener, TopologyListener):
+        _topology_listeners.append(listener)
+    else:
+        raise TypeError("listener must be an instance of PoolListener, "
+                        "CommandListener or TopologyListener")
+
+
+def unregister(listener):
+    """Unregister a listener registered by :func:`register`.
+    """
+    for listeners in (_pool_listeners, _command_listeners,
+                      _topology_listeners):
+        if listener in listeners:
+            listeners.remove(listener)
+
+
+def _publish(listeners, event, *args):
+    for listener in listeners:
+        try:
+            getattr(listener, event)(*args)
+        except Exception:
+            # a listener never breaks the operation it listens to
+            logger.exception('{0} failed handling {1}'.format(listener, event))
+
+
+def _command_event(op_type, namespace, command_name=None, spec=None,
+                   batch_size=None):
+    """A :class:`CommandEvent` to be given along with the message to its
+    connection, None when no command listener is registered.
+    """
+    if _command_listeners:
+        return CommandEvent(op_type, namespace, command_name, spec,
+                            batch_size)
+
+
+def _message_event(data):
+    """A :class:`CommandEvent` for the packed message `data`, when the
+    operation isn't known to the caller. None when no command listener
+    is registered.
+    """
+    if not _command_listeners:
+        return None
+
+    op_type = _OP_TYPES.get(struct.unpack_from("<i", data, 12)[0])
+    if op_type == 'killCursors':
+        return CommandEvent(op_type, None)
+
+    # the collection name follows the header and a 32 bit int
+    end = data.index("\x00", 20)
+    namespace = data[20:end]
+    if op_type != 'query' or not namespace.endswith('.$cmd'):
+        return CommandEvent(op_type, namespace)
+
+    offset = end + 9  # skip and limit
+    size = struct.unpack_from("<i", data, offset)[0]
+    spec = bson.BSON(data[offset:offset + size]).decode(SON)
+    return CommandEvent('command', namespace, next(iter(spec), None), spec)
+
+
+def _command_started(event, request_id, node, payload_size):
+    event.request_id = request_id
+    event.node = node
+    event.payload_size = payload_size
+    event._sent_at = time.time()
+    _publish(_command_listeners, 'started', event)
+
+
+def _command_written(event):
+    event._written_at = time.time()
+    event.send_time = event._written_at - event._sent_at
+
+
+def _command_replied(event, reply_size):
+    event.round_trip = time.time() - (event._written_at or event._sent_at)
+    event.reply_size = (event.reply_size or 0) + reply_size
+
+
+def _command_decoded(event, decode_time):
+    event.decode_time = (event.decode_time or 0) + decode_time
+
+
+def _command_succeeded(event):
+    if event:
+        _publish(_command_listeners, 'succeeded', event)
+
+
+def _command_failed(event, error):
+    if event:
+        event.error = error
+        _publish(_command_listeners, 'failed', event)
@@ -17,22 +17,46 @@
 
 import logging
 import random
+import time
+from datetime import timedelta
 from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
 from bson import SON
+from mongotor import message
+from mongotor import monitoring
 from mongotor.pool import ConnectionPool
 from mongotor.connection import Connection
-from mongotor.errors import InterfaceError, TooManyConnections
+from mongotor.errors import InterfaceError, DatabaseError, NotMasterError, \
+    TooManyConnections
 
 logger = logging.getLogger(__name__)
 
 
 class Node(object):
     """Node of database cluster
+
+    Server cursors abandoned by their cursors are killed together by a
+    single killCursors message, sent `kill_cursors_delay` seconds after
+    the first of them was abandoned.
+
+    `ping_time` is a moving average of the seconds taken by the ismaster
+    command of :meth:`config`, None until the node answered it.
+    `outstanding` and `latency` tell the load of the node from its pool.
+
+    The node is checked on a connection of its own, so a busy pool never
+    delays the check. Changes of its :attr:`state` are published to the
+    topology listeners of :mod:`mongotor.monitoring`.
+
+    `members` are the ``host:port`` addresses of the replica set members
+    the node reported, its hosts, passives and arbiters, and
+    `primary_address` the address of the primary it knows. `tags` are
+    the tags of the node in the replica set config.
     """
 
     def __init__(self, host, port, database, pool_kargs=None):
-        if not pool_kargs:
-            pool_kargs = {}
+        pool_kargs = dict(pool_kargs or {})
+        self.kill_cursors_delay = pool_kargs.pop('kill_cursors_delay', 1)
 
         assert isinstance(host, (str, unicode))
         assert isinstance(port, int)
@@ -44,44 +68,164 @@ class Node(object):
 
         self.is_primary = False
         self.is_secondary = False
+        self.is_arbiter = False
         self.available = False
         self.initialized = False
+        self.ping_time = None
+        self.members = []
+        self.primary_address = None
+        self.tags = {}
+
+        self._monitor = None
+        self._checking = False
+        self._check_callbacks = []
+
+        self._dead_cursors = []
+        self._kill_cursors_timeout = None
 
         self.pool = ConnectionPool(self.host, self.port, self.database.dbname,
                                    **self.pool_kargs)
 
+    @property
+    def state(self):
+        if not self.initialized:
+            return 'unknown'
+        if not self.available:
+            return 'unavailable'
+        if self.is_primary:
+            return 'primary'
+        if self.is_secondary:
+            return 'secondary'
+        if self.is_arbiter:
+            return 'arbiter'
+        return 'other'
+
     @gen.engine
     def config(self, callback=None):
+        """Check the state of this node with an ismaster command. A check
+        asked for while another is running waits for its result.
+        """
+        if callback:
+            self._check_callbacks.append(callback)
+        if self._checking:
+            return
+
+        self._checking = True
         ismaster = SON([('ismaster', 1)])
+        timeout = self.pool_kargs.get('connect_timeout', 5)
 
-        response = None
+        response, error = None, None
         try:
-            try:
-                connection = yield gen.Task(self.connection)
-            except TooManyConnections:
-                # create a connection on the fly if pool is full
-                connection = Connection(host=self.host, port=self.port)
+            if not self._monitor:
+                self._monitor = Connection(host=self.host, port=self.port,
+                                           timeout=timeout)
+            started = time.time()
             response, error = yield gen.Task(self.database._command, ismaster,
-                                             connection=connection)
-            if not connection._pool:  # if connection is created on the fly
-                connection.close()
-        except InterfaceError, ie:
+                connection=self._monitor, network_timeout=timeout)
+            if response:
+                self._update_ping_time(time.time() - started)
+        except (InterfaceError, DatabaseError), e:
+            error = e
+
+        if error:
             logger.error('oops, database node {host}:{port} is unavailable: {error}'
-                         .format(host=self.host, port=self.port, error=ie))
+                         .format(host=self.host, port=self.port, error=error))
+
+        old_state = self.state
 
         if response:
             self.is_primary = response.get('ismaster', True)
             self.is_secondary = response.get('secondary', False)
+            self.is_arbiter = response.get('arbiterOnly', False)
+            self.members = response.get('hosts', []) + \
+                response.get('passives', []) + response.get('arbiters', [])
+            self.primary_address = response.get('primary')
+            self.tags = response.get('tags', {})
             self.available = True
         else:
             self.available = False
 
         self.initialized = True
+        self._checking = False
 
-        if callback:
+        if self.state != old_state and monitoring._topology_listeners:
+            monitoring._publish(monitoring._topology_listeners,
+                                'node_changed', self, old_state, self.state)
+
+        callbacks, self._check_callbacks = self._check_callbacks, []
+        for callback in callbacks:
             callback()
 
+    def check_error(self, error):
+        """Check the nodes again at once when `error`, raised by an
+        operation on this node, tells the node may have changed state.
+        """
+        if isinstance(error, TooManyConnections):
+            return  # a busy pool, not a change of the node
+
+        if isinstance(error, (InterfaceError, NotMasterError)):
+            self.database._request_check()
+
+    @property
+    def outstanding(self):
+        """Number of operations waiting for a connection or a reply"""
+        return self.pool.outstanding
+
+    @property
+    def latency(self):
+        """Recent seconds between sending a request and reading its reply,
+        the ping time until a reply was read.
+        """
+        latency = self.pool.latency
+        if latency is None:
+            return self.ping_time
+        return latency
+
+    def _update_ping_time(self, elapsed):
+        if self.ping_time is None:
+            self.ping_time = elapsed
+        else:
+            self.ping_time += (elapsed - self.ping_time) * 0.2
+
+    def kill_cursors(self, cursor_ids):
+        """Kill the server cursors `cursor_ids` of this node with the next
+        killCursors message.
+        """
+        self._dead_cursors.extend(cursor_ids)
+
+        if not self._kill_cursors_timeout:
+            # not run in the context of the cursor which started the batch
+            with stack_context.NullContext():
+                self._kill_cursors_timeout = IOLoop.instance().add_timeout(
+                    timedelta(seconds=self.kill_cursors_delay),
+                    self._kill_cursors)
+
+    @gen.engine
+    def _kill_cursors(self):
+        self._kill_cursors_timeout = None
+
+        cursor_ids, self._dead_cursors = self._dead_cursors, []
+        if not cursor_ids:
+            return
+
+        try:
+            connection = yield gen.Task(self.connection)
+            connection.send_message(message.kill_cursors(cursor_ids),
+                callback=None,
+                event=monitoring._command_event('killCursors', None))
+        except InterfaceError, ie:
+            logger.error('could not kill cursors {0} of {1}: {2}'
+                         .format(cursor_ids, self, ie))
+
     def disconnect(self):
+        if self._kill_cursors_timeout:
+            IOLoop.instance().remove_timeout(self._kill_cursors_timeout)
+            self._kill_cursors()
+
+        if self._monitor:
+            self._monitor.close()
+            self._monitor = None
+
         self.pool.close()
 
     def __repr__(self):
@@ -95,6 +239,30 @@ class Node(object):
         self.pool.connection(callback)
 
 
+class Balancing(object):
+    """Defines how reads are balanced among the members they may go to.
+
+    * `RANDOM`: Each read goes to a random member.
+    * `LEAST_LOADED`: Each read goes to the least loaded of two random
+      members, the one with the fewest operations outstanding, weighted
+      by its recent latency.
+    """
+
+    RANDOM = 0
+    LEAST_LOADED = 1
+
+    @classmethod
+    def load(cls, node):
+        return (node.outstanding + 1) * (node.latency or 0), node.outstanding
+
+    @classmethod
+    def select(cls, nodes, balancing=None):
+        if balancing == cls.LEAST_LOADED and len(nodes) > 1:
+            return min(random.sample(nodes, 2), key=cls.load)
+
+        return random.choice(nodes)
+
+
 class ReadPreference(object):
     """Defines the read preferences supported by mongotor.
 
@@ -105,7 +273,16 @@ class ReadPreference(object):
       is raised if no secondaries are available.
     * `SECONDARY_PREFERRED`: Queries are distributed among secondaries,
       or the primary if no secondary is available.
-    * TODO: `NEAREST`: Queries are distributed among all members.
+    * `NEAREST`: Queries are distributed among all members.
+
+    Queries distributed among members only go to the members whose
+    `ping_time` is within `latency_window` seconds of the nearest one.
+
+    `tag_sets` restricts those members to the ones tagged in the replica
+    set config with all the tags of a tag set, e.g.
+    ``[{'use': 'reporting', 'dc': 'east'}, {'use': 'reporting'}]``.
+    The tag sets are tried in order, the empty tag set ``{}`` matches
+    any member. Queries sent to the primary ignore the tag sets.
     """
 
     PRIMARY = 0
@@ -113,7 +290,7 @@ class ReadPreference(object):
     SECONDARY = 2
     SECONDARY_ONLY = 2
     SECONDARY_PREFERRED = 3
-    #NEAREST = 4
+    NEAREST = 4
 
     @classmethod
     def select_primary_node(cls, nodes):
@@ -122,25 +299,62 @@ class ReadPreference(object):
                 return node
 
     @classmethod
-    def select_random_node(cls, nodes, secondary_only):
+    def select_random_node(cls, nodes, secondary_only, latency_window=None,
+                           balancing=None, tag_sets=None):
         candidates = []
 
         for node in nodes:
             if not node.available:
                 continue
 
+            if not node.is_primary and not node.is_secondary:
+                continue  # an arbiter holds no data
+
             if secondary_only and node.is_primary:
                 continue
 
             candidates.append(node)
 
+        if tag_sets:
+            candidates = cls.select_tagged_nodes(candidates, tag_sets)
+
         if not candidates:
             return None
 
-        return random.choice(candidates)
+        if latency_window is not None:
+            candidates = cls.select_near_nodes(candidates, latency_window)
+
+        return Balancing.select(candidates, balancing)
+
+    @classmethod
+    def select_tagged_nodes(cls, nodes, tag_sets):
+        """Get the nodes matching the first tag set matched by any node"""
+        for tag_set in tag_sets:
+            tagged = [node for node in nodes
+                      if all(node.tags.get(key) == value
+                             for key, value in tag_set.iteritems())]
+            if tagged:
+                return tagged
+
+        return []
 
     @classmethod
-    def select_node(cls, nodes, mode=None):
+    def select_near_nodes(cls, nodes, latency_window):
+        """Get the nodes whose ping time is within `latency_window` seconds
+        of the nearest one, all of them until their ping time is known.
+        """
+        measured = [node for node in nodes if node.ping_time is not None]
+        if not measured:
+            return nodes
+
+        nearest = min(node.ping_time for node in measured)
+
+        return [node for node in measured
+                if node.ping_time <= nearest + latency_window]
+
+    @classmethod
+    def select_node(cls, nodes, mode=None, latency_window=None,
+                    balancing=None, tag_sets=None):
         if mode is None:
             mode = cls.PRIMARY
 
@@ -152,14 +366,24 @@ class ReadPreference(object):
             if primary_node:
                 return primary_node
             else:
-                return cls.select_node(nodes, cls.SECONDARY)
+                return cls.select_node(nodes, cls.SECONDARY, latency_window,
+                                       balancing, tag_sets)
 
         if mode == cls.SECONDARY:
-            return cls.select_random_node(nodes, secondary_only=True)
+            return cls.select_random_node(nodes, secondary_only=True,
+                latency_window=latency_window, balancing=balancing,
+                tag_sets=tag_sets)
 
         if mode == cls.SECONDARY_PREFERRED:
-            secondary_node = cls.select_random_node(nodes, secondary_only=True)
+            secondary_node = cls.select_random_node(nodes, secondary_only=True,
+                latency_window=latency_window, balancing=balancing,
+                tag_sets=tag_sets)
             if secondary_node:
                 return secondary_node
             else:
                 return cls.select_primary_node(nodes)
+
+        if mode == cls.NEAREST:
+            return cls.select_random_node(nodes, secondary_only=False,
+                latency_window=latency_window, balancing=balancing,
+                tag_sets=tag_sets)
@@ -14,84 +14,559 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import bisect
 import logging
+import random
+import time
+from collections import deque
 from datetime import timedelta
 from threading import Condition
-from tornado.ioloop import IOLoop
+from tornado import stack_context
+from tornado.ioloop import IOLoop, PeriodicCallback
 from functools import partial
 from mongotor.connection import Connection
+from mongotor import monitoring
 from mongotor.errors import TooManyConnections
 
 log = logging.getLogger(__name__)
 
+# upper bounds, in seconds, of the buckets of the checkout wait histogram
+WAIT_TIME_BUCKETS = (0.001, 0.01, 0.1, 1)
+
+
+class AdaptivePoolSize(object):
+    """Additive increase, multiplicative decrease sizing of connection pools.
+
+    Every `interval` seconds the number of connections a pool may open,
+    kept between `minconnections` (at least one) and `maxconnections`
+    (unbounded when 0), is:
+
+    * multiplied by `decrease` when the average latency of its
+      connections is above `max_latency`, a busy server gets no more load
+    * increased by `increase` when a request waited more than `max_wait`
+      seconds for a connection
+    * decreased by the connections which were idle through the whole
+      interval, at most multiplied by `decrease`
+
+    The same instance can size many pools.
+
+    :Parameters:
+      - `max_wait` (optional): seconds a request may wait for a connection
+        before the pool grows
+      - `max_latency` (optional): seconds of average latency above which
+        the pool shrinks. 0 ignores latency
+      - `increase` (optional): connections added when the pool grows
+      - `decrease` (optional): factor applied when the pool shrinks
+      - `interval` (optional): seconds between resizes
+      - `on_resize` (optional): called with the pool, its old and its new
+        size on each resize
+    """
+
+    def __init__(self, max_wait=0.01, max_latency=0, increase=1,
+                 decrease=0.5, interval=1, on_resize=None):
+        assert increase > 0
+        assert 0 < decrease < 1
+
+        self.max_wait = max_wait
+        self.max_latency = max_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.on_resize = on_resize
+
+    def resize(self, size, waited, latency, idle):
+        """Get the new size of a pool.
+
+        :Parameters:
+          - `size`: the current size
+          - `waited`: the longest wait for a connection in seconds
+          - `latency`: the average latency of the connections in seconds,
+            None when unknown
+          - `idle`: the connections which were idle the whole time
+        """
+        if self.max_latency and latency is not None and \
+                latency > self.max_latency:
+            return int(size * self.decrease)
+
+        if waited > self.max_wait:
+            return size + self.increase
+
+        if idle:
+            return max(size - idle, int(size * self.decrease))
+
+        return size
+
 
 class ConnectionPool(object):
     """Connection Pool
 
+    Connections are opened on demand up to `maxconnections`, and at
+    least `minconnections` are opened in background once the ioloop runs,
+    so creating a pool never waits for the network.
+
     :Parameters:
+      - `minconnections` (optional): connections kept open, idle ones
+        included
       - `maxconnections` (optional): maximum open connections for this pool. 0 for unlimited
       - `maxusage` (optional): number of requests allowed on a connection before it is closed. 0 for unlimited
       - `dbname`: mongo database name
       - `autoreconnect`: autoreconnect on database
+      - `connect_timeout` (optional): seconds to wait for a connection to be
+        stabilished
+      - `pipelined` (optional): share connections between concurrent requests
+        instead of handing each request its own connection. `maxconnections`
+        then caps the shared connections and defaults to one
+      - `coalesce_writes` (optional): write the messages sent on a connection
+        during an ioloop iteration in a single socket write
+      - `wait_queue_timeout` (optional): seconds to wait for a connection
+        when `maxconnections` are in use, before failing with
+        :class:`~mongotor.errors.TooManyConnections`. 0 waits forever
+      - `wait_queue_size` (optional): maximum requests waiting for a
+        connection, more fail at once with
+        :class:`~mongotor.errors.TooManyConnections`. 0 for unlimited
+      - `max_idle_time` (optional): seconds an idle connection is kept
+        open while more than `minconnections` are open. 0 for unlimited
+      - `max_lifetime` (optional): seconds a connection is used before it
+        is closed and replaced. 0 for unlimited
+      - `lifetime_jitter` (optional): fraction of `max_lifetime` randomly
+        taken from the lifetime of each connection, so connections opened
+        together are not replaced together
+      - `adaptive` (optional): an :class:`AdaptivePoolSize` which resizes
+        the pool between `minconnections` and `maxconnections` as the
+        load changes
 
     """
     def __init__(self, host, port, dbname, maxconnections=0, maxusage=0,
-                 autoreconnect=True):
+                 autoreconnect=True, connect_timeout=5, pipelined=False,
+                 coalesce_writes=False, wait_queue_timeout=1,
+                 wait_queue_size=0, minconnections=0, max_idle_time=0,
+                 max_lifetime=0, lifetime_jitter=0.1, adaptive=None):
 
         assert isinstance(host, (str, unicode))
         assert isinstance(port, int)
+        assert isinstance(minconnections, int)
         assert isinstance(maxconnections, int)
+        assert not maxconnections or minconnections <= maxconnections
         assert isinstance(maxusage, int)
         assert isinstance(dbname, (str, unicode))
         assert isinstance(autoreconnect, bool)
+        assert isinstance(pipelined, bool)
+        assert isinstance(coalesce_writes, bool)
+        assert isinstance(wait_queue_size, int)
+        assert 0 <= lifetime_jitter < 1
 
         self._host = host
         self._port = port
+        self._minconnections = minconnections
         self._maxconnections = maxconnections
+        self._adaptive = adaptive
+        self._size = maxconnections
+        if adaptive:
+            self._size = max(minconnections, 1)
+        self._max_waited = 0
+        self._min_idle = None
         self._maxusage = maxusage
         self._autoreconnect = autoreconnect
+        self._connect_timeout = connect_timeout
+        self._pipelined = pipelined
+        self._coalesce_writes = coalesce_writes
+        self._wait_queue_timeout = wait_queue_timeout
+        self._wait_queue_size = wait_queue_size
+        self._max_idle_time = max_idle_time
+        self._max_lifetime = max_lifetime
+        self._lifetime_jitter = lifetime_jitter
+        self._idle_since = {}
+        self._deadlines = {}
         self._connections = 0
-        self._idle_connections = []
+        self._in_use = set()
+        self._idle_connections = deque()
+        self._waiters = deque()
+        self._waiting = 0
+        self._shared_connections = []
         self._condition = Condition()
+        self._warming = False
+        self._closed = False
+        self._reaper = None
+        self._broken = set()
+        self._created = 0
+        self._closed_by = {}
+        self._checkouts = 0
+        self._checkout_seconds = deque(maxlen=10)
+        self._wait_times = [0] * (len(WAIT_TIME_BUCKETS) + 1)
 
-        for i in range(self._maxconnections):
-            conn = self._create_connection()
-            self._idle_connections.append(conn)
+        self._schedule_warm_up()
+
+        limits = [limit for limit in (max_idle_time, max_lifetime) if limit]
+        if limits:
+            # check the connections a few times in the shortest limit
+            self._reaper = PeriodicCallback(partial(self._run_logged, self._reap),
+                                            min(limits) * 1000 / 4.0)
+            with stack_context.NullContext():
+                self._reaper.start()
+
+        self._resizer = None
+        self._grow_timeout = None
+        if adaptive:
+            self._resizer = PeriodicCallback(partial(self._run_logged, self._resize),
+                                             adaptive.interval * 1000)
+            with stack_context.NullContext():
+                self._resizer.start()
 
     def __repr__(self):
         return "ConnectionPool {0}:{1}:{2} using:{3}, idle:{4} :::: "\
             .format(id(self), self._host, self._port, self._connections, len(self._idle_connections))
 
+    def _run_logged(self, func, *args, **kwargs):
+        """Run a pool task scheduled on the ioloop, its failures are
+        logged instead of reaching whichever caller scheduled it
+        """
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            log.exception('{0} {1} failed'.format(self, func.__name__))
+
     def _create_connection(self):
         log.debug('{0} creating new connection'.format(self))
-        return Connection(host=self._host, port=self._port, pool=self,
-                          autoreconnect=self._autoreconnect)
+        conn = Connection(host=self._host, port=self._port, pool=self,
+                          autoreconnect=self._autoreconnect,
+                          timeout=self._connect_timeout,
+                          pipelined=self._pipelined,
+                          coalesce_writes=self._coalesce_writes)
+
+        if self._max_lifetime:
+            jitter = random.random() * self._lifetime_jitter
+            self._deadlines[conn] = time.time() + \
+                self._max_lifetime * (1 - jitter)
+
+        self._created += 1
+        if monitoring._pool_listeners:
+            monitoring._publish(monitoring._pool_listeners,
+                                'connection_created', self, conn)
+
+        return conn
+
+    def _expired(self, conn):
+        """Get why `conn` must be replaced, None while it's usable"""
+        if self._maxusage and conn.usage > self._maxusage:
+            return 'maxusage'
+
+        deadline = self._deadlines.get(conn)
+        if deadline is not None and time.time() >= deadline:
+            return 'lifetime'
+
+    def _retire(self, conn, reason):
+        self._deadlines.pop(conn, None)
+        self._idle_since.pop(conn, None)
+        self._broken.discard(conn)
+        if not conn.in_flight and not conn.closed():
+            conn.close()
+
+        self._count_closed(conn, reason)
+
+    def _count_closed(self, conn, reason):
+        self._closed_by[reason] = self._closed_by.get(reason, 0) + 1
+        if monitoring._pool_listeners:
+            monitoring._publish(monitoring._pool_listeners,
+                                'connection_closed', self, conn, reason)
+
+    def _checked_out(self, conn, waited=0):
+        self._checkouts += 1
+        conn._checkout_wait = waited
+        self._wait_times[bisect.bisect_left(WAIT_TIME_BUCKETS, waited)] += 1
+
+        second = int(time.time())
+        if self._checkout_seconds and self._checkout_seconds[-1][0] == second:
+            self._checkout_seconds[-1][1] += 1
+        else:
+            self._checkout_seconds.append([second, 1])
+
+        if monitoring._pool_listeners:
+            monitoring._publish(monitoring._pool_listeners,
+                                'connection_checked_out', self, conn, waited)
+
+    def _checked_in(self, conn):
+        if monitoring._pool_listeners:
+            monitoring._publish(monitoring._pool_listeners,
+                                'connection_checked_in', self, conn)
+
+    def stats(self):
+        """Get the state and the counters of this pool.
+
+        Returns a dict with the ``open``, ``idle`` and ``in_use``
+        connections, the ``size`` limit of the pool, the requests
+        ``waiting`` for a connection and ``in_flight`` on them, the
+        connections ``created`` and ``closed`` by reason, the
+        ``checkouts`` and ``checkouts_per_second`` over the last seconds,
+        a ``wait_time`` histogram as a list of ``(upper bound in seconds,
+        checkouts)`` pairs, the last bound being None, and the
+        ``connections`` with their usage, latency and bytes sent and
+        received.
+        """
+        if self._pipelined:
+            connections = list(self._shared_connections)
+            in_use = len([conn for conn in connections if conn.in_flight])
+        else:
+            connections = list(self._in_use) + list(self._idle_connections)
+            in_use = self._connections
+
+        now = int(time.time())
+        recent = [count for second, count in self._checkout_seconds
+                  if now - second < self._checkout_seconds.maxlen]
+
+        return {
+            'host': self._host,
+            'port': self._port,
+            'open': self._open_connections(),
+            'idle': len(self._idle_connections),
+            'in_use': in_use,
+            'size': self._size,
+            'waiting': self._waiting,
+            'in_flight': sum(conn.in_flight for conn in connections),
+            'created': self._created,
+            'closed': dict(self._closed_by),
+            'checkouts': self._checkouts,
+            'checkouts_per_second': sum(recent) / float(self._checkout_seconds.maxlen),
+            'wait_time': zip(WAIT_TIME_BUCKETS + (None,), self._wait_times),
+            'connections': [{'usage': conn.usage,
+                             'in_flight': conn.in_flight,
+                             'latency': conn.latency,
+                             'bytes_sent': conn.bytes_sent,
+                             'bytes_received': conn.bytes_received}
+                            for conn in connections],
+        }
+
+    @property
+    def outstanding(self):
+        """Number of requests waiting for a connection or for a reply"""
+        if self._pipelined:
+            connections = self._shared_connections
+        else:
+            connections = self._in_use
+
+        return self._waiting + sum(conn.in_flight for conn in connections)
+
+    @property
+    def latency(self):
+        """Average latency of the open connections, None until a reply
+        was read on one of them.
+        """
+        if self._pipelined:
+            connections = self._shared_connections
+        else:
+            connections = list(self._in_use) + list(self._idle_connections)
+
+        latencies = [conn.latency for conn in connections
+                     if conn.latency is not None]
+        if not latencies:
+            return None
+
+        return sum(latencies) / len(latencies)
+
+    def _make_idle(self, conn):
+        self._idle_since[conn] = time.time()
+        self._idle_connections.append(conn)
+
+    def _reap(self):
+        """Close the idle connections unused for `max_idle_time`, keeping
+        `minconnections` open, and the connections past their lifetime.
+        """
+        now = time.time()
+        removable = self._open_connections() - self._minconnections
+
+        idle_connections = deque()
+        for conn in self._idle_connections:
+            idle = now - self._idle_since.get(conn, now)
+            reason = self._expired(conn)
+            if not reason and self._max_idle_time and removable > 0 and \
+                    idle >= self._max_idle_time:
+                reason = 'idle'
+
+            if reason:
+                log.debug('{0} {1} reaping idle connection'.format(self, conn))
+                self._retire(conn, reason)
+                removable -= 1
+            else:
+                idle_connections.append(conn)
+        self._idle_connections = idle_connections
+
+        for conn in list(self._shared_connections):
+            reason = self._expired(conn)
+            if reason:
+                log.debug('{0} {1} retiring shared connection'.format(self, conn))
+                self._shared_connections.remove(conn)
+                self._retire(conn, reason)
+
+        self._schedule_warm_up()
+
+    def _resize(self, grow_only=False):
+        now = time.time()
+
+        waited = self._max_waited
+        for callback, timeout, since in self._waiters:
+            if callback:
+                waited = max(waited, now - since)
+                break
+
+        connections = list(self._in_use) + list(self._idle_connections) + \
+            self._shared_connections
+        latencies = [conn.latency for conn in connections
+                     if conn.latency is not None]
+        latency = latencies and sum(latencies) / len(latencies) or None
+
+        idle = self._min_idle
+        if idle is None:
+            idle = len(self._idle_connections)
+
+        size = self._adaptive.resize(self._size, waited, latency, idle)
+        size = max(size, self._minconnections, 1)
+        if self._maxconnections:
+            size = min(size, self._maxconnections)
+
+        if grow_only and size <= self._size:
+            return
+
+        self._max_waited = 0
+        self._min_idle = None
+
+        if size == self._size:
+            return
+
+        log.debug('{0} resizing from {1} to {2}'.format(self, self._size, size))
+        old_size, self._size = self._size, size
+        self._apply_size()
+
+        if self._adaptive.on_resize:
+            self._adaptive.on_resize(self, old_size, size)
+        if monitoring._pool_listeners:
+            monitoring._publish(monitoring._pool_listeners, 'pool_resized',
+                                self, old_size, size)
 
-    def connection(self, callback=None, retries=0):
+    def _schedule_grow(self):
+        if self._grow_timeout or self._size == self._maxconnections:
+            return
+
+        # waiters shouldn't wait for the next resize to get connections
+        with stack_context.NullContext():
+            self._grow_timeout = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._adaptive.max_wait),
+                partial(self._run_logged, self._grow))
+
+    def _grow(self):
+        self._grow_timeout = None
+        if self._waiting:
+            self._resize(grow_only=True)
+
+    def _apply_size(self):
+        """Open connections for the waiters the pool may now serve, and
+        close the idle ones it may no longer keep.
+        """
+        if self._pipelined:
+            for conn in list(self._shared_connections):
+                if len(self._shared_connections) <= self._size:
+                    break
+                if not conn.in_flight:
+                    self._shared_connections.remove(conn)
+                    self._retire(conn, 'shrink')
+            return
+
+        while self._connections < self._size:
+            callback, waited = self._next_waiter()
+            if not callback:
+                break
+
+            conn = self._create_connection()
+            self._in_use.add(conn)
+            self._connections += 1
+            self._checked_out(conn, waited)
+            # the waiter's callback runs in its own wrapped context
+            with stack_context.NullContext():
+                IOLoop.instance().add_callback(
+                    partial(self._hand_over, callback, conn))
+
+        while self._idle_connections and self._open_connections() > self._size:
+            self._retire(self._idle_connections.popleft(), 'shrink')
+
+    def _open_connections(self):
+        if self._pipelined:
+            return len(self._shared_connections)
+        return self._connections + len(self._idle_connections)
+
+    def _schedule_warm_up(self):
+        if self._warming or self._closed or \
+                self._open_connections() >= self._minconnections:
+            return
+
+        self._warming = True
+        # not run in the context of the request which released or reaped
+        with stack_context.NullContext():
+            IOLoop.instance().add_callback(
+                partial(self._run_logged, self._warm_up))
+
+    def _warm_up(self):
+        """Open idle connections until `minconnections` are open, their
+        sockets connect without blocking the ioloop.
+        """
+        self._warming = False
+        if self._closed:
+            return
+
+        while self._open_connections() < self._minconnections:
+            conn = self._create_connection()
+            if self._pipelined:
+                self._shared_connections.append(conn)
+            else:
+                self._make_idle(conn)
+
+    def _shared_connection(self):
+        """Get the least loaded shared connection, a new one is opened
+        while all of them have requests in flight and the limit allows it
+        """
+        conn = None
+        if self._shared_connections:
+            conn = min(self._shared_connections, key=lambda c: c.in_flight)
+
+        if conn is None or (conn.in_flight and
+                            len(self._shared_connections) < (self._size or 1)):
+            conn = self._create_connection()
+            self._shared_connections.append(conn)
+
+        self._checked_out(conn)
+        return conn
+
+    def connection(self, callback=None):
         """Get a connection from pool
 
+        When `maxconnections` connections are in use the callback waits,
+        in FIFO order, for a connection to be released.
+
         :Parameters:
           - `callback` : method which will be called when connection is ready
 
         """
+        if self._pipelined:
+            callback(self._shared_connection())
+            return
+
         self._condition.acquire()
         try:
-            try:
-                conn = self._idle_connections.pop(0)
-            except IndexError:
-                if self._maxconnections and self._connections >= self._maxconnections:
-                    if retries > 10:
-                        raise TooManyConnections()
-
-                    log.warn('{0} too many connections, retries {1}'.format(self, retries))
-                    retry_connection = partial(self.connection, retries=(retries + 1), callback=callback)
-                    IOLoop.instance().add_timeout(timedelta(microseconds=300), retry_connection)
-
-                    return
-
+            if self._idle_connections:
+                # the most recently used, so the others can be reaped
+                conn = self._idle_connections.pop()
+                self._idle_since.pop(conn, None)
+                if self._min_idle is None or \
+                        len(self._idle_connections) < self._min_idle:
+                    self._min_idle = len(self._idle_connections)
+            elif self._size and self._connections >= self._size:
+                self._wait(callback)
+                return
+            else:
                 conn = self._create_connection()
 
             self._connections += 1
+            self._in_use.add(conn)
+            self._broken.discard(conn)
+            self._checked_out(conn)
+            conn._checked_out = True
 
         finally:
             self._condition.release()
@@ -99,42 +574,160 @@ class ConnectionPool(object):
         log.debug('{0} {1} connection retrieved'.format(self, conn))
         callback(conn)
 
+    def _hand_over(self, callback, conn):
+        # until the waiter gets it, releases from the previous holder
+        # (e.g. its socket close) must not give the connection away again
+        conn._checked_out = True
+        callback(conn)
+
+    def _wait(self, callback):
+        if self._wait_queue_size and self._waiting >= self._wait_queue_size:
+            raise TooManyConnections('too many requests waiting for a connection')
+
+        log.debug('{0} too many connections, waiting'.format(self))
+
+        # [callback, timeout, since], the callback is cleared when the wait
+        # times out and the waiter is skipped once it reaches the queue head
+        waiter = [stack_context.wrap(callback), None, time.time()]
+        if self._wait_queue_timeout:
+            waiter[1] = IOLoop.instance().add_timeout(
+                timedelta(seconds=self._wait_queue_timeout),
+                partial(self._on_wait_timeout, waiter))
+
+        self._waiters.append(waiter)
+        self._waiting += 1
+
+        if self._adaptive:
+            self._schedule_grow()
+
+    def _on_wait_timeout(self, waiter):
+        waiter[0] = None
+        self._waiting -= 1
+        self._max_waited = max(self._max_waited, time.time() - waiter[2])
+
+        raise TooManyConnections('timed out waiting for a connection')
+
+    def _next_waiter(self):
+        """Get the callback of the oldest waiter and the seconds it waited"""
+        while self._waiters:
+            callback, timeout, since = self._waiters.popleft()
+            if callback is None:
+                continue  # timed out
+
+            waited = time.time() - since
+            self._waiting -= 1
+            self._max_waited = max(self._max_waited, waited)
+            if timeout:
+                IOLoop.instance().remove_timeout(timeout)
+            return callback, waited
+
+        return None, 0
+
     def release(self, conn):
-        if self._maxusage and conn.usage > self._maxusage:
-            if not conn.closed():
-                log.debug('{0} {1} connection max usage expired, renewing...'.format(self, conn))
-                self._connections -= 1
-                conn.close()
+        if self._pipelined:
+            self._release_shared(conn)
             return
 
         self._condition.acquire()
+        try:
+            if conn not in self._in_use or not conn._checked_out:
+                log.debug('{0} {1} called by socket close'.format(self, conn))
+                if conn in self._idle_since and conn.closed() and \
+                        conn not in self._broken and not self._closed:
+                    # an idle connection lost, it reconnects when used
+                    self._broken.add(conn)
+                    self._count_closed(conn, 'error')
+                return
 
-        if conn in self._idle_connections:
-            log.debug('{0} {1} called by socket close'.format(self, conn))
-            self._condition.release()
-            return
+            conn._checked_out = False
+            self._checked_in(conn)
+            if conn.closed() and conn not in self._broken:
+                self._broken.add(conn)
+                self._count_closed(conn, 'error')
 
-        try:
-            self._idle_connections.append(conn)
-            self._condition.notify()
-        finally:
+            callback, waited = self._next_waiter()
+
+            reason = self._expired(conn)
+            if reason:
+                log.debug('{0} {1} connection expired, renewing...'.format(self, conn))
+                self._in_use.discard(conn)
+                self._connections -= 1
+                self._retire(conn, reason)
+
+                if not callback:
+                    self._schedule_warm_up()
+                    return
+
+                conn = self._create_connection()
+                self._in_use.add(conn)
+                self._connections += 1
+
+            if callback:
+                # the oldest waiter gets the connection without it going
+                # through the idle connections
+                log.debug('{0} {1} connection handed over'.format(self, conn))
+                self._checked_out(conn, waited)
+                # the waiter's callback runs in its own wrapped context
+                with stack_context.NullContext():
+                    IOLoop.instance().add_callback(
+                        partial(self._hand_over, callback, conn))
+                return
+
+            self._in_use.discard(conn)
+            self._make_idle(conn)
             self._connections -= 1
+
+        finally:
             self._condition.release()
 
         log.debug('{0} {1} release connection'.format(self, conn))
 
+    def _release_shared(self, conn):
+        shared = conn in self._shared_connections
+        if shared:
+            self._checked_in(conn)
+
+        reason = self._expired(conn)
+        if not reason and not conn.closed():
+            return
+
+        if shared:
+            log.debug('{0} {1} retiring shared connection'.format(self, conn))
+            self._shared_connections.remove(conn)
+            if not reason and not self._closed:
+                self._count_closed(conn, 'error')
+
+        if reason and shared:
+            self._retire(conn, reason)
+            self._schedule_warm_up()
+        elif reason and not conn.in_flight and not conn.closed():
+            conn.close()  # retired while it had requests in flight
+
     def close(self):
         """Close all connections in the pool."""
         log.debug('{0} closing...'.format(self))
+        self._closed = True
+        if self._reaper:
+            self._reaper.stop()
+        if self._resizer:
+            self._resizer.stop()
+        if self._grow_timeout:
+            IOLoop.instance().remove_timeout(self._grow_timeout)
+            self._grow_timeout = None
         self._condition.acquire()
         try:
             while self._idle_connections:  # close all idle connections
-                con = self._idle_connections.pop(0)
+                con = self._idle_connections.popleft()
                 try:
                     con.close()
                 except Exception:
                     pass
-                self._connections -= 1
-            self._condition.notifyAll()
+                self._count_closed(con, 'pool closed')
+            while self._shared_connections:
+                con = self._shared_connections.pop()
+                con.close()
+                self._count_closed(con, 'pool closed')
+            self._idle_since.clear()
+            self._deadlines.clear()
         finally:
             self._condition.release()
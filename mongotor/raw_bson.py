@@ -0,0 +1,66 @@
+# coding: utf-8
+# <mongotor - An asynchronous driver and toolkit for accessing MongoDB with Tornado>
+# Copyright (C) <2012>  Marcel Nicolay <marcel.nicolay@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import bson
+
+
+class RawBSONDocument(collections.Mapping):
+    """A read only document which keeps its BSON bytes and is only decoded
+    when one of its fields is accessed.
+
+    >>> document = RawBSONDocument(bson.BSON.encode({'name': 'mongotor'}))
+    >>> document.raw  # BSON bytes, nothing decoded yet
+    >>> document['name']
+
+    :Parameters:
+      - `raw`: BSON bytes of the document
+      - `as_class` (optional): class used when the document is decoded
+      - `tz_aware` (optional): decode dates as timezone aware datetimes
+    """
+    __slots__ = ('raw', '_as_class', '_tz_aware', '_document')
+
+    def __init__(self, raw, as_class=dict, tz_aware=False):
+        self.raw = raw
+        self._as_class = as_class
+        self._tz_aware = tz_aware
+        self._document = None
+
+    def _decoded(self):
+        if self._document is None:
+            self._document = bson.BSON(self.raw).decode(self._as_class,
+                                                        self._tz_aware)
+        return self._document
+
+    def __getitem__(self, key):
+        return self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __eq__(self, other):
+        if isinstance(other, RawBSONDocument):
+            return self.raw == other.raw
+        return self._decoded() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "RawBSONDocument(%r)" % (self.raw,)
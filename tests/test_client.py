@@ -2,6 +2,7 @@
 from tornado.ioloop import IOLoop
 from tornado import testing
 from mongotor.database import Database
+from mongotor import monitoring
 from bson import ObjectId
 from datetime import datetime
 import sure
@@ -117,6 +118,22 @@ class ClientTestCase(testing.AsyncTestCase):
         response[1]['_id'].should.be(documents[1]['_id'])
         error.should.be.none
 
+    def test_find_document_with_network_timeout(self):
+        """[ClientTestCase] - find returns TimeoutError when network timeout expires"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+        self.wait()
+
+        db.collection_test.find({'$where': 'sleep(500) || true'},
+            network_timeout=0.1, callback=self.stop)
+        response, error = self.wait()
+
+        response.should.be.none
+        error.should.be.a('mongotor.errors.TimeoutError')
+        db._nodes[0].pool._connections.should.be.equal(0)
+
     def test_find_one_document(self):
         """[ClientTestCase] - find one document"""
         db = Database.init(["localhost:27027", "localhost:27028"],
@@ -275,6 +292,132 @@ class ClientTestCase(testing.AsyncTestCase):
             db.articles.remove({}, callback=self.stop)
             self.wait()
 
+    def test_parallel_scan(self):
+        """[ClientTestCase] - scan a collection with many cursors"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        documents = [{'_id': i} for i in range(10)]
+        db.collection_test.insert(documents, callback=self.stop)
+        self.wait()
+
+        found = []
+
+        def on_document(result):
+            document, error = result
+            if error or document is None:
+                self.stop(error)
+            else:
+                found.append(document)
+
+        db.collection_test.parallel_scan(3, on_document, batch_size=2)
+        error = self.wait()
+
+        error.should.be.none
+        sorted(found).should.be.equal(documents)
+
+    def test_parallel_scan_with_more_cursors_than_connections(self):
+        """[ClientTestCase] - scan a collection with more cursors than connections"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test', maxconnections=1)
+
+        documents = [{'_id': i} for i in range(10)]
+        db.collection_test.insert(documents, callback=self.stop)
+        self.wait()
+
+        found = []
+
+        def on_document(result):
+            document, error = result
+            if error or document is None:
+                self.stop(error)
+            else:
+                found.append(document)
+
+        db.collection_test.parallel_scan(3, on_document, batch_size=2)
+        error = self.wait()
+
+        error.should.be.none
+        sorted(found).should.be.equal(documents)
+
+    def _stub_commands(self, db, responses):
+        """Answer the commands named in `responses` without the server,
+        returns the commands sent with their read preferences."""
+        sent = []
+        command = db._command
+
+        def _command(spec, read_preference=None, callback=None, **kwargs):
+            name = next(iter(spec))
+            sent.append((name, spec, read_preference))
+            if name in responses:
+                callback((responses[name], None))
+            else:
+                command(spec, read_preference=read_preference,
+                        callback=callback, **kwargs)
+
+        db._command = _command
+        return sent
+
+    def _parallel_scan(self, db, num_cursors):
+        found = []
+
+        def on_document(result):
+            document, error = result
+            if error or document is None:
+                self.stop(error)
+            else:
+                found.append(document)
+
+        db.collection_test.parallel_scan(num_cursors, on_document,
+            batch_size=2)
+        error = self.wait()
+
+        error.should.be.none
+        return found
+
+    def test_parallel_scan_split_by_split_vector(self):
+        """[ClientTestCase] - scan a collection split by the splitVector command"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        documents = [{'_id': i} for i in range(10)]
+        db.collection_test.insert(documents, callback=self.stop)
+        self.wait()
+
+        sent = self._stub_commands(db, {
+            'parallelCollectionScan': {'ok': 0.0, 'errmsg': 'no such cmd'},
+            'collStats': {'ok': 1.0, 'size': 1000, 'count': 10},
+            'splitVector': {'ok': 1.0, 'splitKeys': [{'_id': 3}, {'_id': 6}]}})
+
+        sorted(self._parallel_scan(db, 3)).should.be.equal(documents)
+
+        commands = dict((name, (spec, read_preference))
+                        for name, spec, read_preference in sent)
+        split_vector, read_preference = commands['splitVector']
+        split_vector['splitVector'].should.be.equal('test.collection_test')
+        split_vector['maxChunkSizeBytes'].should.be.equal(333)
+        split_vector['maxChunkObjects'].should.be.equal(3)
+        commands['collStats'][1].should.be.equal(read_preference)
+
+    def test_parallel_scan_split_by_lowest_and_highest_id(self):
+        """[ClientTestCase] - scan a collection split between its lowest and highest _id"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+
+        documents = [{'_id': i} for i in range(10)]
+        db.collection_test.insert(documents, callback=self.stop)
+        self.wait()
+
+        sent = self._stub_commands(db, {
+            'parallelCollectionScan': {'ok': 0.0, 'errmsg': 'no such cmd'},
+            'collStats': {'ok': 1.0, 'size': 1000, 'count': 10},
+            'splitVector': {'ok': 0.0, 'errmsg': 'not authorized'}})
+
+        sorted(self._parallel_scan(db, 3)).should.be.equal(documents)
+
+        [name for name, spec, read_preference in sent][:3].should.be.equal(
+            ['parallelCollectionScan', 'collStats', 'splitVector'])
+
     def test_group(self):
         """[ClientTestCase] - group command"""
         db = Database.init(["localhost:27027", "localhost:27028"],
@@ -345,3 +488,88 @@ class ClientTestCase(testing.AsyncTestCase):
         result['comment'].should.have.length_of(1)
         result['comment'][0]['author'].should.be.equal('joe')
         _.should.be.none
+
+    def test_command_listener(self):
+        """[ClientTestCase] - publish the operations to command listeners"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+        db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+        self.wait()
+
+        events = []
+
+        class Listener(monitoring.CommandListener):
+
+            def started(self, event):
+                events.append(('started', event.op_type))
+
+            def succeeded(self, event):
+                events.append(('succeeded', event))
+
+        listener = Listener()
+        monitoring.register(listener)
+        try:
+            db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+            self.wait()
+            db.collection_test.find(limit=-1, callback=self.stop)
+            self.wait()
+            db.command('count', 'collection_test', callback=self.stop)
+            self.wait()
+        finally:
+            monitoring.unregister(listener)
+
+        [name for name, _ in events].should.be.equal(['started', 'succeeded'] * 3)
+
+        insert, query, command = [event for name, event in events[1::2]]
+
+        insert.op_type.should.be.equal('insert')
+        insert.namespace.should.be.equal('test.collection_test')
+        insert.node.should.be.equal('localhost:27027')
+        insert.payload_size.should.be.greater_than(0)
+        insert.round_trip.should.be.greater_than(0)
+
+        query.op_type.should.be.equal('query')
+        query.reply_size.should.be.greater_than(36)
+        query.decode_time.should.be.greater_than(0)
+
+        command.op_type.should.be.equal('command')
+        command.command_name.should.be.equal('count')
+        command.namespace.should.be.equal('test.$cmd')
+
+    def test_slow_operation_log(self):
+        """[ClientTestCase] - keep the slow operations with their query shape"""
+        db = Database.init(["localhost:27027", "localhost:27028"],
+            dbname='test')
+        db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+        self.wait()
+
+        slow_operations = monitoring.SlowOperationLog(threshold=0, size=2)
+        fast_operations = monitoring.SlowOperationLog(threshold=60)
+        monitoring.register(slow_operations)
+        monitoring.register(fast_operations)
+        try:
+            db.collection_test.insert({'_id': ObjectId()}, callback=self.stop)
+            self.wait()
+            db.collection_test.find({'name': 'shouldbename',
+                'age': {'$in': [1, 2]}}, limit=-1, callback=self.stop)
+            self.wait()
+            db.collection_test.find({'age': {'$gt': 1}}, callback=self.stop)
+            self.wait()
+        finally:
+            monitoring.unregister(slow_operations)
+            monitoring.unregister(fast_operations)
+
+        fast_operations.operations.should.be.empty
+        slow_operations.operations.should.have.length_of(2)
+
+        operation = slow_operations.operations[0]
+        operation['slow'].should.be.ok
+        operation['op_type'].should.be.equal('query')
+        operation['shape'].should.be.equal({'name': '?', 'age': {'$in': ['?']}})
+        operation['node'].should.be.equal('localhost:27027')
+        operation['batch_size'].should.be.equal(-1)
+        operation['duration'].should.be.greater_than(0)
+        operation['round_trip'].should.be.greater_than(0)
+        operation['error'].should.be.none
+
+        slow_operations.operations[1]['shape'].should.be.equal({'age': {'$gt': '?'}})
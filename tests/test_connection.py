@@ -1,9 +1,13 @@
 # coding: utf-8
 from __future__ import with_statement
+from functools import partial
 from tornado.ioloop import IOLoop
 from tornado import testing
+from tornado import iostream
+from tornado import stack_context
 from mongotor.connection import Connection
-from mongotor.errors import InterfaceError, DatabaseError, IntegrityError
+from mongotor.errors import InterfaceError, DatabaseError, IntegrityError, \
+    ProgrammingError, TimeoutError
 from bson import ObjectId
 from mongotor import message
 from mongotor import helpers
@@ -25,11 +29,40 @@ class ConnectionTestCase(testing.AsyncTestCase):
         super(ConnectionTestCase, self).tearDown()
         self.conn.close()
 
-    def test_not_connect_to_mongo_raises_error(self):
-        """[ConnectionTestCase] - Raises error when can't connect to mongo"""
+    def test_not_connect_to_mongo_returns_error(self):
+        """[ConnectionTestCase] - Returns error when can't connect to mongo"""
 
-        Connection.when.called_with(host="localhost", port=27000) \
-            .should.throw(InterfaceError, "Connection refused")
+        conn = Connection(host="localhost", port=27000)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        conn.send_message_with_response(message_test, callback=self.stop)
+        response, error = self.wait()
+
+        response.should.be.none
+        error.should.be.a(InterfaceError)
+        str(error).should.be.equal("[Errno 111] Connection refused")
+        conn.closed().should.be.ok
+
+    def test_returns_error_when_connect_timed_out(self):
+        """[ConnectionTestCase] - Returns error when connect times out"""
+
+        def connect(stream, address, callback=None):
+            stream._connecting = True  # never connects
+
+        with fudge.patched_context(iostream.IOStream, 'connect', connect):
+            conn = Connection(host="localhost", port=27027, timeout=0.1)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        conn.send_message_with_response(message_test, callback=self.stop)
+        response, error = self.wait()
+
+        response.should.be.none
+        error.should.be.a(InterfaceError)
+        str(error).should.be.equal('connection timed out')
 
     def test_connect_to_mongo(self):
         """[ConnectionTestCase] - Can stabilish connection to mongo"""
@@ -53,6 +86,145 @@ class ConnectionTestCase(testing.AsyncTestCase):
         result['ok'].should.be(1.0)
         result['str'].should.be(str(object_id))
 
+    def test_close_connection_when_response_times_out(self):
+        """[ConnectionTestCase] - Close connection when response times out"""
+
+        self.conn.send_message(message.insert('mongotor_test.timeout',
+            [{'_id': ObjectId()}], False, True, {}), True, callback=self.stop)
+        self.wait()
+
+        message_query = message.query(0, 'mongotor_test.timeout', 0, 0,
+            {'$where': 'sleep(500) || true'})
+
+        self.conn.send_message_with_response(message_query, callback=self.stop,
+            network_timeout=0.1)
+        response, error = self.wait()
+
+        response.should.be.none
+        error.should.be.a(TimeoutError)
+        self.conn.closed().should.be.ok
+
+        self.conn.send_message(message.delete('mongotor_test.timeout', {},
+            True, {}), True, callback=self.stop)
+        self.wait()
+
+    def test_raises_error_when_connection_in_use(self):
+        """[ConnectionTestCase] - Raises ProgrammingError when connection is in use"""
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        self.conn.send_message_with_response(message_test, callback=self.stop)
+
+        self.conn.send_message_with_response.when.called_with(message_test,
+            callback=None).should.throw(ProgrammingError, 'connection already in use')
+
+        self.wait()
+
+    def test_pipeline_messages_in_same_connection(self):
+        """[ConnectionTestCase] - Pipeline many messages in the same connection"""
+
+        self.conn = Connection(host="localhost", port=27027, pipelined=True)
+
+        object_ids = [ObjectId() for i in range(10)]
+        results = {}
+
+        def on_response(object_id, result):
+            response, error = result
+            results[object_id] = helpers._unpack_response(response)['data'][0]
+            if len(results) == len(object_ids):
+                self.stop()
+
+        for object_id in object_ids:
+            message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+                {'driverOIDTest': object_id})
+            self.conn.send_message_with_response(message_test,
+                callback=partial(on_response, object_id))
+
+        self.conn.in_flight.should.be.equal(10)
+        self.wait()
+
+        self.conn.in_flight.should.be.equal(0)
+        for object_id in object_ids:
+            results[object_id]['oid'].should.be.equal(object_id)
+
+    def test_keep_pipelined_connection_when_a_callback_raises(self):
+        """[ConnectionTestCase] - Keep a pipelined connection open when a callback raises"""
+
+        self.conn = Connection(host="localhost", port=27027, pipelined=True)
+
+        def on_response(result):
+            raise ValueError('application error')
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+        with stack_context.NullContext():
+            self.conn.send_message_with_response(message_test,
+                callback=on_response)
+
+        object_id = ObjectId()
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': object_id})
+        self.conn.send_message_with_response(message_test, callback=self.stop)
+        response, error = self.wait()
+
+        error.should.be.none
+        helpers._unpack_response(response)['data'][0]['oid'] \
+            .should.be.equal(object_id)
+        self.conn.closed().should_not.be.ok
+
+    def test_fail_every_pipelined_request_when_a_callback_raises(self):
+        """[ConnectionTestCase] - Fail every pipelined request of a closed connection when a callback raises"""
+
+        self.conn = Connection(host="localhost", port=27027, pipelined=True)
+
+        def on_response(result):
+            raise ValueError('application error')
+
+        failed = []
+
+        def on_failure(result):
+            response, error = result
+            failed.append(error)
+
+        with stack_context.NullContext():
+            for callback in [on_response] + [on_failure] * 5:
+                message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+                    {'driverOIDTest': ObjectId()})
+                self.conn.send_message_with_response(message_test,
+                    callback=callback)
+
+        self.conn.close()
+
+        failed.should.have.length_of(5)
+        for error in failed:
+            error.should.be.a(InterfaceError)
+        self.conn.in_flight.should.be.equal(0)
+
+    def test_coalesce_messages_written_in_same_iteration(self):
+        """[ConnectionTestCase] - Coalesce messages written in the same ioloop iteration"""
+
+        self.conn = Connection(host="localhost", port=27027, pipelined=True,
+            coalesce_writes=True)
+
+        responses = []
+
+        def on_response(result):
+            responses.append(result)
+            if len(responses) == 10:
+                self.stop()
+
+        for i in range(10):
+            message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+                {'driverOIDTest': ObjectId()})
+            self.conn.send_message_with_response(message_test,
+                callback=on_response)
+
+        self.wait()
+
+        self.conn.flushes.should.be.equal(1)
+        self.conn.coalesced.should.be.equal(10)
+
     def test_close_connection_to_mongo(self):
         """[ConnectionTestCase] - Can close connection to mongo"""
 
@@ -93,8 +265,6 @@ class ConnectionTestCase(testing.AsyncTestCase):
         """[ConnectionTestCase] - Reconnect to mongo when connection was lost"""
 
         self.conn.close()
-        self.conn._callback = self.stop
-        self.wait()
 
         self.test_send_test_message_to_mongo()
 
@@ -1,10 +1,16 @@
 # coding: utf-8
+from datetime import timedelta
 from tornado.ioloop import IOLoop
 from tornado import testing
+from tornado import stack_context
 from bson.objectid import ObjectId
+from bson.son import SON
+import bson
 from mongotor import message
 from mongotor.cursor import Cursor, DESCENDING, ASCENDING
+from mongotor.connection import Connection
 from mongotor.database import Database
+from mongotor.errors import InvalidOperationError, InterfaceError
 from mongotor.node import ReadPreference
 import sure
 
@@ -36,7 +42,10 @@ class CursorTestCase(testing.AsyncTestCase):
         Database.disconnect()
 
     def _insert_document(self, document):
-        message_insert = message.insert('mongotor_test.cursor_test', [document],
+        self._insert_documents([document])
+
+    def _insert_documents(self, documents):
+        message_insert = message.insert('mongotor_test.cursor_test', documents,
             True, True, {})
 
         Database().get_node(ReadPreference.PRIMARY, callback=self.stop)
@@ -172,6 +181,381 @@ class CursorTestCase(testing.AsyncTestCase):
         str(result['_id']).should.be.equal(str(document2['_id']))
         error.should.be.none
 
+    def test_find_raw_documents(self):
+        """[CursorTestCase] - Find documents as raw BSON"""
+
+        document = {'_id': ObjectId(), 'name': 'should be name'}
+        self._insert_document(document)
+
+        cursor = Cursor(Database(), 'cursor_test', document['_id'], limit=-1,
+            raw=True, as_class=SON)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        result.should.be.a('mongotor.raw_bson.RawBSONDocument')
+        bson.BSON(result.raw).decode().should.be.equal(document)
+        result['name'].should.be.equal(document['name'])
+        result._decoded().should.be.a(SON)
+        error.should.be.none
+
+    def test_stream_documents(self):
+        """[CursorTestCase] - Stream documents as they are read"""
+
+        documents = [{'_id': ObjectId(), 'name': 'should be name %d' % i}
+            for i in range(3)]
+        for document in documents:
+            self._insert_document(document)
+
+        found = []
+        cursor = Cursor(Database(), 'cursor_test', sort={'name': ASCENDING})
+        cursor.stream(found.append, callback=self.stop)
+
+        count, error = self.wait()
+
+        count.should.be.equal(3)
+        found.should.be.equal(documents)
+        error.should.be.none
+
+    def test_find_documents_beyond_first_batch(self):
+        """[CursorTestCase] - Find documents beyond the first batch"""
+
+        documents = [{'_id': i} for i in range(250)]
+        self._insert_documents(documents)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING})
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        result.should.be.equal(documents)
+        error.should.be.none
+        cursor.alive.should_not.be.ok
+
+    def test_get_next_batch_of_documents(self):
+        """[CursorTestCase] - Get documents batch by batch"""
+
+        documents = [{'_id': i} for i in range(5)]
+        self._insert_documents(documents)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2)
+        pool = Database()._nodes[0].pool
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+
+        batch.should.be.equal(documents[:2])
+        cursor.alive.should.be.ok
+        pool._connections.should.be.equal(1)
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+        batch.should.be.equal(documents[2:4])
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+        batch.should.be.equal(documents[4:])
+
+        cursor.alive.should_not.be.ok
+        pool._connections.should.be.equal(0)
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+        batch.should.be.equal([])
+
+    def test_find_documents_with_limit_beyond_batch_size(self):
+        """[CursorTestCase] - Find documents with limit greater than batch size"""
+
+        documents = [{'_id': i} for i in range(10)]
+        self._insert_documents(documents)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=3, limit=7)
+        cursor.find(callback=self.stop)
+
+        result, error = self.wait()
+
+        result.should.be.equal(documents[:7])
+
+    def test_iterate_over_each_document(self):
+        """[CursorTestCase] - Iterate over each document"""
+
+        documents = [{'_id': i} for i in range(5)]
+        self._insert_documents(documents)
+
+        found = []
+
+        def each(result):
+            document, error = result
+            if document is None:
+                self.stop()
+            else:
+                found.append(document)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2)
+        cursor.each(callback=each)
+        self.wait()
+
+        found.should.be.equal(documents)
+
+    def test_prefetch_next_batch(self):
+        """[CursorTestCase] - Prefetch the next batch while the current one is handled"""
+
+        documents = [{'_id': i} for i in range(7)]
+        self._insert_documents(documents)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2, prefetch=1)
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+
+        batch.should.be.equal(documents[:2])
+        cursor._fetching.should.be.equal(1)
+
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        result.should.be.equal(documents[2:])
+        cursor.alive.should_not.be.ok
+
+    def test_prefetch_many_batches_one_after_the_other(self):
+        """[CursorTestCase] - Prefetch many batches one after the other in a connection not pipelined"""
+
+        documents = [{'_id': i} for i in range(11)]
+        self._insert_documents(documents)
+
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2, prefetch=3)
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+
+        batch.should.be.equal(documents[:2])
+
+        self.io_loop.add_timeout(timedelta(seconds=0.1), self.stop)
+        self.wait()
+
+        cursor._ready.should.have.length_of(3)
+        cursor._fetching.should.be.equal(0)
+
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        result.should.be.equal(documents[2:])
+        cursor.alive.should_not.be.ok
+
+    def test_prefetch_many_batches_in_pipelined_connection(self):
+        """[CursorTestCase] - Prefetch many batches in a pipelined connection"""
+
+        documents = [{'_id': i} for i in range(11)]
+        self._insert_documents(documents)
+
+        connection = Connection('localhost', 27027, pipelined=True)
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2, prefetch=3, connection=connection)
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+
+        batch.should.be.equal(documents[:2])
+        connection.in_flight.should.be.equal(3)
+
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        result.should.be.equal(documents[2:])
+        cursor.alive.should_not.be.ok
+        connection.close()
+
+    def test_close_cursor_release_connection(self):
+        """[CursorTestCase] - Close an alive cursor releasing its connection"""
+
+        self._insert_documents([{'_id': i} for i in range(5)])
+
+        cursor = Cursor(Database(), 'cursor_test', batch_size=2)
+        pool = Database()._nodes[0].pool
+
+        cursor.next_batch(callback=self.stop)
+        self.wait()
+
+        pool._connections.should.be.equal(1)
+        cursor.close()
+
+        cursor.alive.should_not.be.ok
+        pool._connections.should.be.equal(0)
+
+    def test_release_connection_once_when_get_more_fails(self):
+        """[CursorTestCase] - Release the connection of a failed cursor once"""
+
+        Database.disconnect()
+        Database.init(["localhost:27027", "localhost:27028"],
+            dbname='mongotor_test', maxconnections=1)
+
+        self._insert_documents([{'_id': i} for i in range(5)])
+
+        cursor = Cursor(Database(), 'cursor_test', batch_size=2, prefetch=0)
+        pool = Database()._nodes[0].pool
+
+        cursor.next_batch(callback=self.stop)
+        self.wait()
+
+        served = []
+        pool.connection(served.append)
+        pool.connection(served.append)
+
+        connection = cursor._pinned_connection
+        cursor.next_batch(callback=self.stop)
+        connection.in_flight.should.be.equal(1)
+        connection._close(InterfaceError('connection closed'))
+
+        batch, error = self.wait()
+        error.should.be.a(InterfaceError)
+
+        self.io_loop.add_timeout(timedelta(seconds=0.05), self.stop)
+        self.wait()
+
+        served.should.be.equal([connection])
+        pool._waiting.should.be.equal(1)
+
+        # back to the pool, through the second waiter
+        connection.release()
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        connection.release()
+
+    def test_kill_closed_cursors_at_once(self):
+        """[CursorTestCase] - Kill the server cursors of closed cursors with one message"""
+
+        self._insert_documents([{'_id': i} for i in range(5)])
+
+        node = Database()._nodes[0]
+        node.kill_cursors_delay = 0.05
+        pool = node.pool
+
+        cursors = []
+        for i in range(2):
+            cursor = Cursor(Database(), 'cursor_test', batch_size=2)
+            cursor.next_batch(callback=self.stop)
+            self.wait()
+            cursors.append(cursor)
+
+        cursor_ids = [cursor._cursor_id for cursor in cursors]
+        for cursor in cursors:
+            cursor.close()
+
+        node._dead_cursors.should.be.equal(cursor_ids)
+        pool._connections.should.be.equal(0)
+
+        self.io_loop.add_timeout(timedelta(seconds=0.1), self.stop)
+        self.wait()
+
+        node._dead_cursors.should.be.empty
+        pool._connections.should.be.equal(0)
+
+    def test_kill_cursors_apart_from_the_cursor_context(self):
+        """[CursorTestCase] - Kill the server cursors out of the context of the cursor which closed first"""
+
+        node = Database()._nodes[0]
+        node.kill_cursors_delay = 0.01
+
+        def _kill_cursors():
+            node._kill_cursors_timeout = None
+            raise ValueError('kill cursors error')
+
+        node._kill_cursors = _kill_cursors
+
+        handled = []
+
+        def handle_error(type, value, traceback):
+            handled.append(value)
+            return True
+
+        with stack_context.ExceptionStackContext(handle_error):
+            node.kill_cursors([42])
+
+        self.io_loop.add_timeout(timedelta(seconds=0.05), self.stop)
+        self.wait()
+
+        handled.should.be.empty
+        node._dead_cursors = []
+
+    def test_kill_abandoned_cursor(self):
+        """[CursorTestCase] - Kill the server cursor of a garbage collected cursor"""
+
+        self._insert_documents([{'_id': i} for i in range(5)])
+
+        node = Database()._nodes[0]
+        cursor = Cursor(Database(), 'cursor_test', batch_size=2)
+        cursor.next_batch(callback=self.stop)
+        self.wait()
+
+        cursor_id = cursor._cursor_id
+        del cursor
+
+        node._dead_cursors.should.be.equal([cursor_id])
+        node.pool._connections.should.be.equal(0)
+
+    def test_exhaust_cursor_without_get_more(self):
+        """[CursorTestCase] - Exhaust cursor reads every batch sending only the query"""
+
+        documents = [{'_id': i} for i in range(7)]
+        self._insert_documents(documents)
+
+        connection = Connection('localhost', 27027)
+        cursor = Cursor(Database(), 'cursor_test', sort={'_id': ASCENDING},
+            batch_size=2, exhaust=True, connection=connection)
+
+        cursor.find(callback=self.stop)
+        result, error = self.wait()
+
+        result.should.be.equal(documents)
+        error.should.be.none
+        connection.usage.should.be.equal(1)
+        connection.in_flight.should.be.equal(0)
+        connection.close()
+
+    def test_raises_error_when_exhaust_on_pipelined_connection(self):
+        """[CursorTestCase] - Raises InvalidOperationError when exhaust is used on a pipelined connection"""
+
+        connection = Connection('localhost', 27027, pipelined=True)
+        cursor = Cursor(Database(), 'cursor_test', batch_size=2, exhaust=True,
+            connection=connection)
+
+        cursor.find(callback=self.stop)
+        self.wait.when.called_with().throw(InvalidOperationError)
+
+        connection.usage.should.be.equal(0)
+        connection.close()
+
+    def test_close_exhaust_cursor(self):
+        """[CursorTestCase] - Close an exhaust cursor while its batches arrive"""
+
+        self._insert_documents([{'_id': i} for i in range(7)])
+
+        cursor = Cursor(Database(), 'cursor_test', batch_size=2, exhaust=True)
+        pool = Database()._nodes[0].pool
+
+        cursor.next_batch(callback=self.stop)
+        batch, error = self.wait()
+
+        batch.should.have.length_of(2)
+        cursor.close()
+        cursor.alive.should_not.be.ok
+
+        self.io_loop.add_timeout(timedelta(seconds=0.1), self.stop)
+        self.wait()
+
+        pool._connections.should.be.equal(0)
+
+    def test_exhaust_cursor_with_limit(self):
+        """[CursorTestCase] - Raises InvalidOperationError using exhaust with limit"""
+
+        Cursor.when.called_with(Database(), 'cursor_test', exhaust=True,
+            limit=2).should.throw(InvalidOperationError)
+
     def test_find_returning_fields(self):
         """[CursorTestCase] - Find and return only selectd fields"""
 
@@ -202,3 +586,56 @@ class CursorTestCase(testing.AsyncTestCase):
         result['comment'].should.have.length_of(1)
         result['comment'][0]['author'].should.be.equal('joe')
         _.should.be.none
+
+    def test_tail_follows_new_documents(self):
+        """[CursorTestCase] - Tail a cursor receiving the documents inserted later"""
+
+        self._insert_documents([{'_id': i} for i in range(2)])
+
+        received = []
+
+        def on_document(result):
+            document, error = result
+            received.append(document['_id'])
+            if len(received) == 2:
+                Database().cursor_test.insert({'_id': 2})
+            elif len(received) == 3:
+                self.stop()
+
+        cursor = Cursor(Database(), 'cursor_test', tailable=True)
+        cursor.tail(on_document, resume_delay=0.05)
+        self.wait()
+        cursor.close()
+
+        received.should.be.equal([0, 1, 2])
+        cursor.alive.should_not.be.ok
+
+    def test_tail_resumes_after_dead_cursor(self):
+        """[CursorTestCase] - Tail sends the query again when the cursor dies"""
+
+        received = []
+
+        def on_document(result):
+            document, error = result
+            received.append(document['_id'])
+            self.stop()
+
+        cursor = Cursor(Database(), 'cursor_test', tailable=True)
+        cursor.tail(on_document, resume_delay=0.05)
+
+        # the collection is empty, the first query returns a dead cursor
+        self.io_loop.add_timeout(timedelta(seconds=0.1),
+            lambda: Database().cursor_test.insert({'_id': 1}))
+        self.wait()
+        cursor.close()
+
+        received.should.be.equal([1])
+        dict(cursor._spec).should.be.equal({'_id': {'$gt': 1}})
+
+    def test_tail_query_options(self):
+        """[CursorTestCase] - Tailable cursors set the await data and oplog replay options"""
+
+        cursor = Cursor(Database(), 'cursor_test', tailable=True,
+            await_data=True, oplog_replay=True)
+
+        cursor._query_options().should.be.equal(2 | 4 | 8 | 32)
@@ -4,6 +4,7 @@ from tornado import testing
 from mongotor.database import Database
 from mongotor.errors import DatabaseError
 from mongotor import message
+from mongotor import monitoring
 from mongotor import helpers
 from bson.objectid import ObjectId
 import sure
@@ -58,6 +59,60 @@ class DatabaseTestCase(testing.AsyncTestCase):
         result['ok'].should.be(1.0)
         result['str'].should.be(str(object_id))
 
+    def test_publish_sent_messages_to_command_listeners(self):
+        """[DatabaseTestCase] - Publish the messages sent to the command listeners"""
+
+        Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+
+        events = []
+
+        class Listener(monitoring.CommandListener):
+
+            def succeeded(self, event):
+                if (event.namespace or '').startswith('mongotor_test.'):
+                    events.append(event)  # not the checks of the nodes
+
+        listener = Listener()
+        monitoring.register(listener)
+        try:
+            message_insert = message.insert('mongotor_test.database_test',
+                [{'_id': ObjectId()}], False, False, {})
+            Database().send_message(message_insert, with_response=False,
+                callback=self.stop)
+            self.wait()
+
+            message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+                {'driverOIDTest': ObjectId()})
+            Database().send_message(message_test, callback=self.stop)
+            self.wait()
+        finally:
+            monitoring.unregister(listener)
+
+        insert, command = events
+
+        insert.op_type.should.be.equal('insert')
+        insert.namespace.should.be.equal('mongotor_test.database_test')
+
+        command.op_type.should.be.equal('command')
+        command.command_name.should.be.equal('driverOIDTest')
+        command.namespace.should.be.equal('mongotor_test.$cmd')
+        command.round_trip.should.be.greater_than(0)
+
+    def test_database_stats(self):
+        """[DatabaseTestCase] - Get the stats of the nodes and their pools"""
+
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        db.collection_test.find({}, callback=self.stop)
+        self.wait()
+
+        stats = db.stats()
+
+        sorted(stats.keys()).should.be.equal(['localhost:27027', 'localhost:27028',
+                                              'localhost:27029'])
+        stats['localhost:27027']['primary'].should.be.ok
+        stats['localhost:27027']['available'].should.be.ok
+        stats['localhost:27027']['pool']['checkouts'].should.be.greater_than(0)
+
     def test_disconnect_database(self):
         """[DatabaseTestCase] - Disconnect the database"""
         Database.init(["localhost:27027"], dbname='test')
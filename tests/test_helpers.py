@@ -0,0 +1,158 @@
+# coding: utf-8
+import struct
+from datetime import datetime
+import unittest
+import bson
+from bson.objectid import ObjectId
+import sure
+from mongotor import helpers
+from mongotor.errors import DatabaseError
+
+
+class UnpackResponseTestCase(unittest.TestCase):
+
+    def _response(self, documents, cursor_id=0):
+        return struct.pack("<iqii", 0, cursor_id, 0, len(documents)) + \
+            "".join([bson.BSON.encode(document) for document in documents])
+
+    def test_unpack_response(self):
+        """[UnpackResponseTestCase] - Unpack response header and documents"""
+        documents = [{'_id': 1, 'name': 'shouldbename'}, {'_id': 2}]
+
+        response = helpers._unpack_response(self._response(documents, 42))
+
+        response['cursor_id'].should.be.equal(42)
+        response['starting_from'].should.be.equal(0)
+        response['number_returned'].should.be.equal(2)
+        response['data'].should.be.equal(documents)
+
+    def _decode_all_calls(self, response, limit):
+        calls = []
+        _decode_all = bson.decode_all
+
+        def decode_all(data, *args):
+            calls.append(len(data))
+            return _decode_all(data, *args)
+
+        _limit = helpers._DECODE_COPY_LIMIT
+        helpers._DECODE_COPY_LIMIT = limit
+        bson.decode_all = decode_all
+        try:
+            documents = helpers._unpack_response(response)['data']
+        finally:
+            bson.decode_all = _decode_all
+            helpers._DECODE_COPY_LIMIT = _limit
+
+        return documents, calls
+
+    def test_unpack_small_response_at_once(self):
+        """[UnpackResponseTestCase] - Unpack a response under the copy limit with a single decode"""
+        documents = [{'_id': i, 'data': 'x' * 1024} for i in range(100)]
+
+        found, calls = self._decode_all_calls(self._response(documents),
+                                              1024 * 1024)
+
+        found.should.be.equal(documents)
+        calls.should.have.length_of(1)
+
+    def test_unpack_large_response_in_slices(self):
+        """[UnpackResponseTestCase] - Unpack a response larger than the copy limit in slices of whole documents"""
+        documents = [{'_id': i, 'data': 'x' * 1024} for i in range(100)]
+        size = len(bson.BSON.encode(documents[0]))
+
+        found, calls = self._decode_all_calls(self._response(documents),
+                                              4 * size)
+
+        found.should.be.equal(documents)
+        calls.should.be.equal([4 * size] * 25)
+
+    def test_unpack_raw_response(self):
+        """[UnpackResponseTestCase] - Unpack response as raw documents"""
+        documents = [{'_id': 1, 'name': 'shouldbename'}, {'_id': 2}]
+
+        response = helpers._unpack_response(self._response(documents), raw=True)
+
+        response['data'].should.have.length_of(2)
+        response['data'][0].raw.should.be.equal(bson.BSON.encode(documents[0]))
+        response['data'][0]['name'].should.be.equal('shouldbename')
+        dict(response['data'][1]).should.be.equal(documents[1])
+
+
+class StreamingReplyTestCase(unittest.TestCase):
+
+    def _response(self, documents, cursor_id=0, flags=0):
+        return struct.pack("<iqii", flags, cursor_id, 0, len(documents)) + \
+            "".join([bson.BSON.encode(document) for document in documents])
+
+    def test_decode_documents_as_bytes_arrive(self):
+        """[StreamingReplyTestCase] - Decode documents as their bytes arrive"""
+        documents = [{'_id': i, 'name': 'shouldbename'} for i in range(3)]
+        response = self._response(documents, 42)
+        first_document_end = 20 + len(bson.BSON.encode(documents[0]))
+
+        found = []
+        reply = helpers._StreamingReply(found.append)
+
+        for i in range(first_document_end):
+            reply.feed(response[i])
+
+        found.should.be.equal(documents[:1])
+
+        reply.feed(response[first_document_end:])
+        found.should.be.equal(documents)
+
+        result = reply.finish()
+        result['cursor_id'].should.be.equal(42)
+        result['number_returned'].should.be.equal(3)
+        reply.count.should.be.equal(3)
+
+    def test_join_chunks_once_a_document_is_complete(self):
+        """[StreamingReplyTestCase] - Keep the chunks apart until a whole document arrived"""
+        document = {'_id': 1, 'name': 'shouldbename' * 10}
+        response = self._response([document])
+
+        found = []
+        reply = helpers._StreamingReply(found.append)
+
+        for i in range(len(response) - 1):
+            reply.feed(response[i])
+
+        found.should.be.empty
+        reply._chunks.should.have.length_of(len(response) - 20 - 1 - 3)
+
+        reply.feed(response[-1])
+        found.should.be.equal([document])
+        reply._chunks.should.be.empty
+
+    def test_raises_error_when_reply_has_error(self):
+        """[StreamingReplyTestCase] - Raises DatabaseError when reply has an error"""
+        reply = helpers._StreamingReply(lambda document: None)
+        reply.feed(self._response([{'$err': 'shouldbeerror'}], flags=2))
+
+        reply.finish.when.called_with().should.throw(DatabaseError,
+            'database error: shouldbeerror')
+
+
+class SplitRangeTestCase(unittest.TestCase):
+
+    def test_split_numbers(self):
+        """[SplitRangeTestCase] - Split a range of numbers"""
+        helpers._split_range(0, 100, 4).should.be.equal([25, 50, 75])
+
+    def test_split_small_range(self):
+        """[SplitRangeTestCase] - Give no repeated bounds for a small range"""
+        helpers._split_range(0, 2, 4).should.be.equal([1])
+
+    def test_split_object_ids(self):
+        """[SplitRangeTestCase] - Split a range of object ids by generation time"""
+        lower = ObjectId.from_datetime(datetime(2013, 1, 1))
+        upper = ObjectId.from_datetime(datetime(2013, 1, 3))
+
+        bounds = helpers._split_range(lower, upper, 2)
+
+        bounds.should.be.equal([ObjectId.from_datetime(datetime(2013, 1, 2))])
+
+    def test_split_other_values(self):
+        """[SplitRangeTestCase] - Give no bounds for values which can't be split"""
+        helpers._split_range('a', 'z', 4).should.be.equal([])
+        helpers._split_range(1, 'z', 4).should.be.equal([])
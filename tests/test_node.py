@@ -1,7 +1,7 @@
 # coding:utf-8
 import unittest
 import sure
-from mongotor.node import ReadPreference, Node
+from mongotor.node import ReadPreference, Node, Balancing
 
 
 class ReadPreferenceTestCase(unittest.TestCase):
@@ -74,4 +74,125 @@ class ReadPreferenceTestCase(unittest.TestCase):
         node_found = ReadPreference.select_node([self.secondary1,
             self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED)
 
-        node_found.should.be.eql(self.primary)
\ No newline at end of file
+        node_found.should.be.eql(self.primary)
+
+    def test_read_preference_nearest(self):
+        """[ReadPreferenceTestCase] - get any node within the latency window when preference is NEAREST"""
+
+        self.primary.ping_time = 0.001
+        self.secondary1.ping_time = 0.010
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.NEAREST, 0.005)
+            node_found.should.be.eql(self.primary)
+
+        nodes_found = set(ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.NEAREST, 0.015)
+            for i in range(50))
+        nodes_found.should.be.equal(set([self.primary, self.secondary1]))
+
+    def test_read_preference_secondary_latency_window(self):
+        """[ReadPreferenceTestCase] - avoid secondaries outside of the latency window"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        self.secondary1.ping_time = 0.030
+        self.secondary2.ping_time = 0.002
+        self.primary.ping_time = 0.001
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY, 0.015)
+            node_found.should.be.eql(self.secondary2)
+
+    def test_read_preference_skips_arbiters(self):
+        """[ReadPreferenceTestCase] - never read from an arbiter"""
+
+        self.secondary2.available = True
+        self.primary.available = False
+        self.secondary1.available = False
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.NEAREST)
+
+        node_found.should.be.none
+
+    def test_read_preference_tag_sets(self):
+        """[ReadPreferenceTestCase] - get the secondaries tagged like the first matching tag set"""
+
+        self.secondary2.available = True
+        self.secondary2.is_secondary = True
+        self.secondary1.tags = {'use': 'interactive', 'dc': 'east'}
+        self.secondary2.tags = {'use': 'reporting', 'dc': 'west'}
+
+        for i in range(20):
+            node_found = ReadPreference.select_node([self.secondary1,
+                self.secondary2, self.primary], ReadPreference.SECONDARY,
+                tag_sets=[{'use': 'reporting', 'dc': 'east'}, {'use': 'reporting'}])
+            node_found.should.be.eql(self.secondary2)
+
+        nodes_found = set(ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY,
+            tag_sets=[{'use': 'analytics'}, {}]) for i in range(50))
+        nodes_found.should.be.equal(set([self.secondary1, self.secondary2]))
+
+    def test_read_preference_tag_sets_not_matched(self):
+        """[ReadPreferenceTestCase] - get the primary when no secondary matches the tag sets and preference is SECONDARY_PREFERRED"""
+
+        self.secondary1.tags = {'use': 'interactive'}
+        tag_sets = [{'use': 'reporting'}]
+
+        ReadPreference.select_node([self.secondary1, self.secondary2,
+            self.primary], ReadPreference.SECONDARY, tag_sets=tag_sets)\
+            .should.be.none
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.SECONDARY_PREFERRED,
+            tag_sets=tag_sets)
+        node_found.should.be.eql(self.primary)
+
+        node_found = ReadPreference.select_node([self.secondary1,
+            self.secondary2, self.primary], ReadPreference.PRIMARY,
+            tag_sets=tag_sets)
+        node_found.should.be.eql(self.primary)
+
+
+class BalancingTestCase(unittest.TestCase):
+
+    class Member(object):
+
+        def __init__(self, outstanding, latency):
+            self.outstanding = outstanding
+            self.latency = latency
+
+    def test_least_loaded_by_outstanding_operations(self):
+        """[BalancingTestCase] - get the member with fewer operations outstanding"""
+        busy = self.Member(outstanding=10, latency=0.001)
+        idle = self.Member(outstanding=0, latency=0.001)
+
+        for i in range(20):
+            Balancing.select([busy, idle], Balancing.LEAST_LOADED).should.be.eql(idle)
+
+    def test_least_loaded_by_latency(self):
+        """[BalancingTestCase] - get the member with lower latency"""
+        slow = self.Member(outstanding=1, latency=0.050)
+        fast = self.Member(outstanding=2, latency=0.002)
+
+        for i in range(20):
+            Balancing.select([slow, fast], Balancing.LEAST_LOADED).should.be.eql(fast)
+
+    def test_least_loaded_among_two_random_members(self):
+        """[BalancingTestCase] - never get the most loaded of many members"""
+        members = [self.Member(outstanding=i, latency=0.001) for i in range(5)]
+
+        for i in range(50):
+            Balancing.select(members, Balancing.LEAST_LOADED).should_not.be.eql(members[-1])
+
+    def test_random(self):
+        """[BalancingTestCase] - get any member by default"""
+        busy = self.Member(outstanding=10, latency=0.001)
+        idle = self.Member(outstanding=0, latency=0.001)
+
+        members = set(Balancing.select([busy, idle]) for i in range(50))
+        members.should.be.equal(set([busy, idle]))
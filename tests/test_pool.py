@@ -1,12 +1,17 @@
 # coding: utf-8
+from datetime import timedelta
+from functools import partial
 from tornado.ioloop import IOLoop
 from tornado import testing
+from tornado import stack_context
 from bson import ObjectId
-from mongotor.pool import ConnectionPool
+from mongotor.pool import ConnectionPool, AdaptivePoolSize
 from mongotor.database import Database
-from mongotor.errors import TooManyConnections
+from mongotor.errors import TooManyConnections, TimeoutError
 from mongotor import message
+from mongotor import monitoring
 import sure
+import unittest
 
 
 class ConnectionPoolTestCase(testing.AsyncTestCase):
@@ -52,10 +57,111 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
         pool.connection(self.stop)
         self.wait.when.called_with().should.throw(TooManyConnections)
 
+    def test_hand_connections_to_waiters_in_fifo_order(self):
+        """[ConnectionPoolTestCase] - Hand released connections to the oldest waiter first"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1)
+
+        pool.connection(self.stop)
+        connection = self.wait()
+
+        served = []
+
+        def waiter(name, conn):
+            served.append(name)
+            pool.release(conn)
+            if len(served) == 2:
+                self.stop()
+
+        pool.connection(partial(waiter, 'first'))
+        pool.connection(partial(waiter, 'second'))
+        pool._waiting.should.be.equal(2)
+
+        pool.release(connection)
+        self.wait()
+
+        served.should.be.equal(['first', 'second'])
+        pool._waiting.should.be.equal(0)
+        pool._connections.should.be.equal(0)
+        pool._idle_connections.should.have.length_of(1)
+
+    def test_raise_too_many_connections_when_wait_queue_is_full(self):
+        """[ConnectionPoolTestCase] - Raise TooManyConnections when the wait queue is full"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1,
+            wait_queue_size=1)
+
+        pool.connection(self.stop)
+        self.wait()
+
+        pool.connection(lambda conn: None)
+
+        pool.connection.when.called_with(lambda conn: None) \
+            .should.throw(TooManyConnections)
+
+    def test_skip_waiters_which_timed_out(self):
+        """[ConnectionPoolTestCase] - Skip the waiters which timed out when a connection is released"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1,
+            wait_queue_timeout=0.05)
+
+        pool.connection(self.stop)
+        connection = self.wait()
+
+        pool.connection(self.stop)
+        self.wait.when.called_with().should.throw(TooManyConnections)
+        pool._waiting.should.be.equal(0)
+
+        pool.release(connection)
+
+        pool._connections.should.be.equal(0)
+        pool._waiters.should.be.empty
+
+    def test_hand_a_timed_out_connection_over_once(self):
+        """[ConnectionPoolTestCase] - Hand a connection whose request timed out to a single waiter"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1)
+
+        pool.connection(self.stop)
+        connection = self.wait()
+
+        connection.send_message(message.insert('mongotor_test.timeout',
+            [{'_id': ObjectId()}], False, True, {}), True, callback=self.stop)
+        self.wait()
+
+        pool.connection(self.stop)
+        self.wait().should.be(connection)
+
+        served = []
+        pool.connection(served.append)
+        pool.connection(served.append)
+
+        message_query = message.query(0, 'mongotor_test.timeout', 0, 0,
+            {'$where': 'sleep(500) || true'})
+        connection.send_message_with_response(message_query,
+            callback=self.stop, network_timeout=0.1)
+        response, error = self.wait()
+        error.should.be.a(TimeoutError)
+
+        self.io_loop.add_timeout(timedelta(seconds=0.05), self.stop)
+        self.wait()
+
+        served.should.be.equal([connection])
+        pool._waiting.should.be.equal(1)
+
+        connection.send_message(message.delete('mongotor_test.timeout', {},
+            True, {}), True, callback=self.stop)
+        self.wait()
+
     def test_close_connection_stream_should_be_release_from_pool(self):
         """[ConnectionPoolTestCase] - Release connection from pool when stream is closed"""
 
-        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=10)
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=10,
+            minconnections=10)
+
+        # let the pool warm up
+        self.io_loop.add_callback(self.stop)
+        self.wait()
 
         pool.connection(self.stop)
         connection = self.wait()
@@ -76,6 +182,225 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
         pool._connections.should.be.equal(0)
         pool._idle_connections.should.have.length_of(10)
 
+    def test_warm_up_minconnections_in_background(self):
+        """[ConnectionPoolTestCase] - Open minconnections in background and more on demand"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', minconnections=2,
+            maxconnections=3)
+
+        pool._idle_connections.should.be.empty
+
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+        pool._idle_connections.should.have.length_of(2)
+
+        connections = []
+        for i in xrange(3):
+            pool.connection(self.stop)
+            connections.append(self.wait())
+
+        set(connections).should.have.length_of(3)
+        pool._connections.should.be.equal(3)
+        pool._idle_connections.should.be.empty
+
+    def test_warm_up_unavailable_node(self):
+        """[ConnectionPoolTestCase] - Create a pool for an unavailable node without failing"""
+
+        pool = ConnectionPool('localhost', 27099, dbname='test', minconnections=2)
+
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+        pool._idle_connections.should.have.length_of(2)
+        pool.close()
+
+    def test_warm_up_apart_from_the_caller_context(self):
+        """[ConnectionPoolTestCase] - Log the warm up failures without reaching the pool creator context"""
+
+        handled = []
+
+        def handle(typ, value, tb):
+            handled.append(value)
+            return True
+
+        def fail():
+            raise ValueError('cannot open a connection')
+
+        with stack_context.ExceptionStackContext(handle):
+            pool = ConnectionPool('localhost', 27027, dbname='test',
+                minconnections=1, max_idle_time=0.05)
+            pool._create_connection = fail
+
+        self.io_loop.add_timeout(timedelta(seconds=0.1), self.stop)
+        self.wait()
+
+        handled.should.be.empty
+        pool.close()
+
+    def test_reap_idle_connections(self):
+        """[ConnectionPoolTestCase] - Close connections idle for max_idle_time keeping minconnections"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', minconnections=1,
+            max_idle_time=0.1)
+
+        connections = []
+        for i in xrange(3):
+            pool.connection(self.stop)
+            connections.append(self.wait())
+
+        for connection in connections:
+            pool.release(connection)
+
+        pool._idle_connections.should.have.length_of(3)
+
+        self.io_loop.add_timeout(timedelta(seconds=0.3), self.stop)
+        self.wait()
+
+        pool._idle_connections.should.have.length_of(1)
+        pool.close()
+
+    def test_replace_connections_after_max_lifetime(self):
+        """[ConnectionPoolTestCase] - Replace connections used for max_lifetime"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', max_lifetime=0.1,
+            lifetime_jitter=0)
+
+        pool.connection(self.stop)
+        connection = self.wait()
+
+        self.io_loop.add_timeout(timedelta(seconds=0.15), self.stop)
+        self.wait()
+
+        pool.release(connection)
+
+        connection.closed().should.be.ok
+        pool._connections.should.be.equal(0)
+        pool._idle_connections.should.be.empty
+
+        pool.connection(self.stop)
+        new_connection = self.wait()
+
+        new_connection.should_not.be.equal(connection)
+        pool.close()
+
+    def test_adaptive_pool_grows_for_waiters(self):
+        """[ConnectionPoolTestCase] - Adaptive pool opens a connection when requests wait"""
+
+        resizes = []
+        adaptive = AdaptivePoolSize(max_wait=0.01, interval=60,
+            on_resize=lambda pool, old, new: resizes.append((old, new)))
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=3,
+            adaptive=adaptive)
+
+        pool.connection(self.stop)
+        connection1 = self.wait()
+
+        pool.connection(self.stop)
+        connection2 = self.wait()
+
+        connection2.should_not.be.equal(connection1)
+        resizes.should.be.equal([(1, 2)])
+        pool._connections.should.be.equal(2)
+        pool.close()
+
+    def test_adaptive_pool_shrinks_when_idle(self):
+        """[ConnectionPoolTestCase] - Adaptive pool closes connections idle through an interval"""
+
+        resizes = []
+        adaptive = AdaptivePoolSize(interval=60,
+            on_resize=lambda pool, old, new: resizes.append((old, new)))
+        pool = ConnectionPool('localhost', 27027, dbname='test', minconnections=1,
+            maxconnections=8, adaptive=adaptive)
+        pool._size = 4
+
+        connections = []
+        for i in xrange(4):
+            pool.connection(self.stop)
+            connections.append(self.wait())
+
+        for connection in connections:
+            pool.release(connection)
+
+        pool._resize()
+        resizes.should.be.equal([(4, 2)])
+        pool._idle_connections.should.have.length_of(2)
+
+        pool._resize()
+        resizes.should.be.equal([(4, 2), (2, 1)])
+        pool._idle_connections.should.have.length_of(1)
+        pool.close()
+
+    def test_pool_stats(self):
+        """[ConnectionPoolTestCase] - Count checkouts, closed connections and bytes"""
+
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxusage=1)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        for i in xrange(2):
+            pool.connection(self.stop)
+            connection = self.wait()
+
+            connection.send_message_with_response(message_test, callback=self.stop)
+            self.wait()
+
+        stats = pool.stats()
+
+        stats['checkouts'].should.be.equal(2)
+        stats['created'].should.be.equal(1)
+        stats['closed'].should.be.equal({'maxusage': 1})
+        stats['open'].should.be.equal(0)
+        stats['wait_time'][0].should.be.equal((0.001, 2))
+        stats['checkouts_per_second'].should.be.greater_than(0)
+
+        pool.connection(self.stop)
+        connection = self.wait()
+        connection.send_message_with_response(message_test, callback=self.stop)
+        self.wait()
+
+        stats = pool.stats()
+
+        stats['idle'].should.be.equal(1)
+        stats['connections'].should.have.length_of(1)
+        stats['connections'][0]['bytes_sent'].should.be.equal(len(message_test[1]))
+        stats['connections'][0]['bytes_received'].should.be.greater_than(16)
+        stats['connections'][0]['latency'].should.be.greater_than(0)
+
+    def test_pool_listener(self):
+        """[ConnectionPoolTestCase] - Publish pool events to listeners"""
+
+        events = []
+
+        class Listener(monitoring.PoolListener):
+
+            def connection_created(self, pool, connection):
+                events.append('created')
+
+            def connection_checked_out(self, pool, connection, waited):
+                events.append('checked out')
+
+            def connection_checked_in(self, pool, connection):
+                events.append('checked in')
+
+            def connection_closed(self, pool, connection, reason):
+                events.append(reason)
+
+        listener = Listener()
+        monitoring.register(listener)
+        try:
+            pool = ConnectionPool('localhost', 27027, dbname='test')
+            pool.connection(self.stop)
+            connection = self.wait()
+            pool.release(connection)
+            pool.close()
+        finally:
+            monitoring.unregister(listener)
+
+        events.should.be.equal(['created', 'checked out', 'checked in',
+                                'pool closed'])
+
     def test_maxusage_in_pool_connections(self):
         """[ConnectionPoolTestCase] - test maxusage in connections"""
         pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=1, maxusage=299)
@@ -143,6 +468,27 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
         pool._idle_connections.should.have.length_of(0)
         pool._connections.should.be.equal(0)
 
+    def test_pipelined_pool_shares_connection(self):
+        """[ConnectionPoolTestCase] - Pipelined pool shares connections between requests"""
+        pool = ConnectionPool('localhost', 27027, dbname='test', maxconnections=2,
+            pipelined=True)
+
+        message_test = message.query(0, 'mongotor_test.$cmd', 0, 1,
+            {'driverOIDTest': ObjectId()})
+
+        connections = []
+        for i in xrange(10):
+            pool.connection(self.stop)
+            connection = self.wait()
+            connection.send_message_with_response(message_test, callback=lambda r: None)
+            connections.append(connection)
+
+        set(connections).should.have.length_of(2)
+        pool._shared_connections.should.have.length_of(2)
+        pool._idle_connections.should.have.length_of(0)
+
+        pool.close()
+
     def test_check_connections_when_use_cursors(self):
         """[ConnectionPoolTestCase] - check connections when use cursors"""
         db = Database.init('localhost:27027', dbname='test', maxconnections=10, maxusage=29)
@@ -160,3 +506,27 @@ class ConnectionPoolTestCase(testing.AsyncTestCase):
             db._nodes[0].pool._connections.should.be.equal(0)
         finally:
             Database.disconnect()
+
+
+class AdaptivePoolSizeTestCase(unittest.TestCase):
+
+    def test_grow_additively_when_requests_wait(self):
+        """[AdaptivePoolSizeTestCase] - Grow additively when requests wait"""
+        adaptive = AdaptivePoolSize(max_wait=0.01, increase=2)
+
+        adaptive.resize(4, 0.02, None, 0).should.be.equal(6)
+        adaptive.resize(4, 0.005, None, 0).should.be.equal(4)
+
+    def test_shrink_multiplicatively_when_latency_climbs(self):
+        """[AdaptivePoolSizeTestCase] - Shrink multiplicatively when latency climbs"""
+        adaptive = AdaptivePoolSize(max_latency=0.1, decrease=0.5)
+
+        adaptive.resize(8, 1, 0.2, 0).should.be.equal(4)
+        adaptive.resize(8, 0, 0.05, 0).should.be.equal(8)
+
+    def test_shrink_idle_connections(self):
+        """[AdaptivePoolSizeTestCase] - Shrink by the idle connections, at most by the decrease factor"""
+        adaptive = AdaptivePoolSize(decrease=0.5)
+
+        adaptive.resize(8, 0, None, 1).should.be.equal(7)
+        adaptive.resize(8, 0, None, 6).should.be.equal(4)
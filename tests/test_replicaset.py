@@ -2,9 +2,11 @@
 from tornado.ioloop import IOLoop
 from tornado import testing
 from bson import ObjectId
-from mongotor.errors import DatabaseError
+from mongotor.errors import DatabaseError, NotMasterError, InterfaceError, \
+    TooManyConnections
+from mongotor import monitoring
 from mongotor.database import Database
-from mongotor.node import ReadPreference
+from mongotor.node import ReadPreference, Balancing
 import sure
 import os
 import time
@@ -35,8 +37,14 @@ class ReplicaSetTestCase(testing.AsyncTestCase):
         secondary_node.host.should.be('localhost')
         secondary_node.port.should.be(27028)
 
+        master_node.ping_time.should.be.greater_than(0)
+        secondary_node.ping_time.should.be.greater_than(0)
+
         nodes = Database()._nodes
-        nodes.should.have.length_of(2)
+        nodes.should.have.length_of(3)  # the arbiter was discovered
+
+        nodes[2].port.should.be(27029)
+        nodes[2].is_arbiter.should.be.ok
 
     def test_raises_error_when_mode_is_secondary_and_secondary_is_down(self):
         """[ReplicaSetTestCase] - Raise error when mode is secondary and secondary is down"""
@@ -81,3 +89,213 @@ class SecondaryPreferredTestCase(testing.AsyncTestCase):
         doc_found, error = self.wait()
 
         doc_found.should.be.eql(doc)
+
+    def test_find_on_least_loaded_node(self):
+        """[SecondaryPreferredTestCase] - test find document from the least loaded node"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+            read_preference=ReadPreference.NEAREST,
+            balancing=Balancing.LEAST_LOADED)
+
+        doc = {'_id': ObjectId()}
+        db.test.insert(doc, callback=self.stop)
+        self.wait()
+
+        db.test.find_one(doc, balancing=Balancing.RANDOM, callback=self.stop)
+        doc_found, error = self.wait()
+
+        doc_found.should.be.eql(doc)
+
+        db.test.find_one(doc, callback=self.stop)
+        doc_found, error = self.wait()
+
+        doc_found.should.be.eql(doc)
+
+
+class TopologyTestCase(testing.AsyncTestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def tearDown(self):
+        super(TopologyTestCase, self).tearDown()
+        Database.disconnect()
+
+    def test_check_nodes_on_dedicated_connections(self):
+        """[TopologyTestCase] - check the nodes without borrowing connections from the pools"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        db._connect(callback=self.stop)
+        self.wait()
+
+        for node in db._nodes:
+            node._monitor.should_not.be.none
+            node.pool.stats()['created'].should.be.equal(0)
+
+    def test_publish_node_changes(self):
+        """[TopologyTestCase] - publish the changes of the state of the nodes"""
+        changes = []
+
+        class Listener(monitoring.TopologyListener):
+
+            def node_changed(self, node, old_state, new_state):
+                changes.append((node.port, old_state, new_state))
+
+        listener = Listener()
+        monitoring.register(listener)
+        try:
+            db = Database.init(["localhost:27027", "localhost:27028"],
+                dbname='test', min_heartbeat_frequency=0.1)
+            db._connect(callback=self.stop)
+            self.wait()
+
+            primary = ReadPreference.select_primary_node(db._nodes)
+            primary.is_primary = False  # a stale state
+            primary.check_error(NotMasterError('not master'))
+
+            IOLoop.instance().add_timeout(time.time() + 0.3, self.stop)
+            self.wait()
+        finally:
+            monitoring.unregister(listener)
+
+        sorted(changes[:3]).should.be.equal([(27027, 'unknown', 'primary'),
+                                             (27028, 'unknown', 'secondary'),
+                                             (27029, 'unknown', 'arbiter')])
+        changes[3:].should.be.equal([(27027, 'other', 'primary')])
+
+    def test_check_nodes_on_errors_of_a_changed_node(self):
+        """[TopologyTestCase] - check the nodes on errors telling a node changed, not on a busy pool"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        db._connect(callback=self.stop)
+        self.wait()
+
+        primary = ReadPreference.select_primary_node(db._nodes)
+        primary.check_error(TooManyConnections('too many connections'))
+        (db._check_deadline - time.time()).should.be.greater_than(25)
+
+        primary.check_error(InterfaceError('connection closed'))
+        (db._check_deadline - time.time()).should.be.lower_than(1)
+
+    def test_check_sooner_without_primary(self):
+        """[TopologyTestCase] - check the nodes often while there is no primary"""
+        db = Database.init(["localhost:27030"], dbname='test',
+            min_heartbeat_frequency=0.1)
+        db._connect(callback=self.stop)
+        self.wait()
+
+        (db._check_deadline - time.time()).should.be.lower_than(0.1)
+
+        Database.disconnect()
+        Database._instance = None
+
+        db = Database.init(["localhost:27027"], dbname='test')
+        db._connect(callback=self.stop)
+        self.wait()
+
+        (db._check_deadline - time.time()).should.be.greater_than(25)
+
+    def test_discover_nodes_from_a_seed(self):
+        """[TopologyTestCase] - discover the members of the replica set from a seed"""
+        added = []
+
+        class Listener(monitoring.TopologyListener):
+
+            def node_added(self, node):
+                added.append(node.port)
+
+        listener = Listener()
+        monitoring.register(listener)
+        try:
+            db = Database.init(["localhost:27028"], dbname='test')
+            db._connect(callback=self.stop)
+            self.wait()
+        finally:
+            monitoring.unregister(listener)
+
+        added.should.be.equal([27027, 27029])
+        [node.port for node in db._nodes].should.be.equal([27028, 27027, 27029])
+
+        # the discovered primary is checked before the database is connected
+        primary = ReadPreference.select_primary_node(db._nodes)
+        primary.port.should.be(27027)
+
+        doc = {'_id': ObjectId()}
+        db.test.insert(doc, callback=self.stop)
+        response, error = self.wait()
+
+        error.should.be.none
+
+    def test_remove_nodes_not_listed_by_the_primary(self):
+        """[TopologyTestCase] - remove the nodes which left the replica set"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        db._connect(callback=self.stop)
+        self.wait()
+
+        primary = ReadPreference.select_primary_node(db._nodes)
+        secondary = db._nodes[1]
+        primary.members.remove('localhost:27028')  # as if reconfigured
+
+        db._discover_nodes().should_not.be.ok
+
+        [node.port for node in db._nodes].should.be.equal([27027, 27029])
+        secondary.pool._closed.should.be.ok
+
+    def test_check_again_the_reported_primary(self):
+        """[TopologyTestCase] - check again the node the others report as the primary"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test')
+        db._connect(callback=self.stop)
+        self.wait()
+
+        primary = db._nodes[0]
+        primary.is_primary = False  # as if checked before its election
+        db._checking = 1
+        db._on_config_node()
+        db._checking.should.be.equal(1)
+
+        self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+        self.wait()
+
+        primary.is_primary.should.be.ok
+        db._checking.should.be.equal(0)
+        (db._check_deadline - time.time()).should.be.greater_than(25)
+
+    def test_stop_checking_nodes_once_disconnected(self):
+        """[TopologyTestCase] - stop checking the nodes once the database is disconnected"""
+        db = Database.init(["localhost:27028"], dbname='test',
+            min_heartbeat_frequency=0.1)
+        db._connect(callback=self.stop)
+        self.wait()
+
+        nodes = list(db._nodes)
+        db._config_nodes()  # a check in flight
+        Database.disconnect()
+
+        self.io_loop.add_timeout(time.time() + 0.3, self.stop)
+        self.wait()
+
+        db._check_timeout.should.be.none
+        db._nodes.should.be.equal(nodes)
+
+        Database.init(["localhost:27027"], dbname='test')  # for tearDown
+
+    def test_find_on_tagged_secondary(self):
+        """[TopologyTestCase] - find documents from secondaries matching tag sets"""
+        db = Database.init(["localhost:27027", "localhost:27028"], dbname='test',
+            read_preference=ReadPreference.SECONDARY, tag_sets=[{'use': 'reporting'}])
+        db._connect(callback=self.stop)
+        self.wait()
+
+        for node in db._nodes:
+            node.tags = {'use': 'reporting'} if node.is_secondary else {}
+
+        doc = {'_id': ObjectId()}
+        db.test.insert(doc, callback=self.stop)
+        self.wait()
+
+        db.test.find_one(doc, callback=self.stop)
+        doc_found, error = self.wait()
+
+        doc_found.should.be.eql(doc)
+
+        db.command('count', 'test', tag_sets=[{'use': 'analytics'}],
+                   callback=self.stop)
+        self.wait.when.called_with().throw(DatabaseError,
+                                           'could not find an available node')